@@ -0,0 +1,354 @@
+"""
+Benchmark every DB query on a large synthetic database, and check that
+none of them acquire unexpected full table scans.
+
+Exits with a nonzero status if a query plan regresses, so that schema and
+index changes can be validated before they are rolled out:
+
+    python -m ltk_scrape.bench_db --num_ltks 1000000
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from dataclasses import replace
+from typing import Callable, Dict, List, Tuple
+
+from .db import DB
+from .profiling import SQL_TRACE_ENV, add_profiling_args, enable_profiling
+
+# Tables which each benchmark is allowed to scan fully. Anything else which
+# shows up as a full scan in a query plan is a regression.
+ALLOWED_SCANS: Dict[str, List[str]] = {
+    "profile_id_counts": ["profiles"],
+    "unvisited_ltks": ["ltks"],
+    "unvisited_ltk_candidates": ["ltks"],
+    "missing_images_product": ["products"],
+    "missing_images_product_with_name": ["products"],
+    "missing_images_product_recent": ["products"],
+    "missing_images_ltk": ["ltks"],
+    "missing_images_product_backlog": ["products"],
+    "missing_images_ltk_backlog": ["ltks"],
+    # The first two run once when scrape_search starts, and captions are read
+    # newest first up to the sample size. search_queries only holds as many
+    # rows as there are mined seeds.
+    "top_retailers": ["products"],
+    "recent_captions": ["ltks"],
+    "next_search_queries": ["search_queries"],
+}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--db_path",
+        type=str,
+        default=None,
+        help="where to generate the database, which must not exist yet, since "
+        "the upsert benchmarks write to it",
+    )
+    parser.add_argument("--num_ltks", type=int, default=1000000)
+    parser.add_argument("--products_per_ltk", type=int, default=2)
+    parser.add_argument("--posts_per_profile", type=int, default=50)
+    parser.add_argument("--repeats", type=int, default=3)
+    add_profiling_args(parser)
+    args = parser.parse_args()
+    enable_profiling(args)
+    if args.db_path is not None and os.path.exists(args.db_path):
+        parser.error(f"refusing to benchmark existing database: {args.db_path}")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = args.db_path or os.path.join(tmp_dir, "bench.db")
+        print(f"generating synthetic database at {db_path}...")
+        t1 = time.time()
+        generate(
+            db_path,
+            num_ltks=args.num_ltks,
+            products_per_ltk=args.products_per_ltk,
+            posts_per_profile=args.posts_per_profile,
+        )
+        print(f"generated in {time.time() - t1:.1f} seconds")
+
+        db = DB(db_path)
+        print(f"{'benchmark':40s} {'best (ms)':>10s}")
+        for name, fn in benchmarks(db):
+            times = []
+            for _ in range(args.repeats):
+                t1 = time.perf_counter()
+                fn()
+                times.append(time.perf_counter() - t1)
+            print(f"{name:40s} {min(times) * 1000:10.2f}")
+
+        failures = check_plans(db_path, os.path.join(tmp_dir, "trace.jsonl"))
+    if failures:
+        print("unexpected full table scans:")
+        for name, scans in failures:
+            print(f"  {name}: {scans}")
+        sys.exit(1)
+    print("all query plans OK")
+
+
+def generate(
+    db_path: str, num_ltks: int, products_per_ltk: int, posts_per_profile: int
+):
+    """
+    Fill a database with synthetic posts and products. Roughly half of the
+    posts are visited, and half of the images and usernames are fetched.
+    """
+    db = DB(db_path)
+    conn = db.connection
+    conn.execute("PRAGMA synchronous = OFF;")
+    rng = random.Random(0)
+    num_profiles = max(1, num_ltks // posts_per_profile)
+    categories = ["clothing", "shoes", "beauty", "home", "accessories"]
+    currencies = ["USD", "EUR", "GBP"]
+    db.set_currency_rates({"USD": 1.0, "EUR": 1.08, "GBP": 1.27})
+
+    batch = 10000
+    for start in range(0, num_ltks, batch):
+        ltk_rows = []
+        product_rows = []
+        for i in range(start, min(num_ltks, start + batch)):
+            profile = rng.randrange(num_profiles)
+            product_ids = [f"p{i}-{j}" for j in range(products_per_ltk)]
+            ltk_rows.append(
+                (
+                    f"l{i}",
+                    f"https://img.example.com/l{i}.jpg",
+                    f"video{i}" if i % 10 == 0 else None,
+                    f"profile{profile}",
+                    f"user{profile}",
+                    "published",
+                    "caption " * rng.randrange(5, 40),
+                    f"https://liketk.it/{i}",
+                    1600000000 + rng.randrange(10**8),
+                    ",".join(product_ids),
+                )
+            )
+            for pid in product_ids:
+                has_details = rng.random() < 0.8
+                price = round(rng.uniform(5, 500), 2) if has_details else None
+                product_rows.append(
+                    (
+                        pid,
+                        f"l{i}",
+                        f"https://shop.example.com/{pid}",
+                        f"https://img.example.com/{pid}.jpg",
+                        f"retailer{rng.randrange(500)}",
+                        f"d{pid}" if has_details else None,
+                        f"product {pid}" if has_details else None,
+                        price,
+                        rng.choice(currencies),
+                        rng.choice(categories),
+                    )
+                )
+        conn.executemany(
+            """
+            INSERT INTO ltks (
+                id, hero_image, video_url, profile_id, profile_user_id, status,
+                caption, share_url, date_published, product_ids
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            ltk_rows,
+        )
+        conn.executemany(
+            """
+            INSERT INTO products (
+                id, ltk_id, hyperlink, image_url, retailer_display_name,
+                details_id, name, price, currency, top_level_category, price_usd
+            ) VALUES (
+                ?1, ?2, ?3, ?4, ?5, ?6, ?7, ?8, ?9, ?10,
+                (SELECT ?8 * usd_rate FROM currency_rates WHERE currency = ?9)
+            )
+            """,
+            product_rows,
+        )
+        conn.executemany(
+            "INSERT INTO visited_ltks (id, error) VALUES (?, NULL)",
+            [(row[0],) for row in ltk_rows if rng.random() < 0.5],
+        )
+        conn.executemany(
+            "INSERT INTO product_images (id, data, error) VALUES (?, ?, NULL)",
+            [(row[0], b"\0" * 64) for row in product_rows if rng.random() < 0.5],
+        )
+        conn.executemany(
+            "INSERT INTO ltk_hero_images (id, data, error) VALUES (?, ?, NULL)",
+            [(row[0], b"\0" * 64) for row in ltk_rows if rng.random() < 0.5],
+        )
+        conn.commit()
+
+    # Raw inserts bypass upsert_ltks, so build the profiles table in one go.
+    conn.execute(
+        """
+        INSERT INTO profiles (id, profile_id, post_count, share_url)
+        SELECT profile_user_id, max(profile_id), count(*), max(share_url)
+        FROM ltks
+        GROUP BY profile_user_id
+        """
+    )
+    conn.executemany(
+        "INSERT INTO usernames (id, username, error) VALUES (?, ?, NULL)",
+        [(f"user{i}", f"name{i}") for i in range(0, num_profiles, 2)],
+    )
+    conn.execute(
+        """
+        UPDATE profiles SET username_status = 'found'
+        WHERE id IN (SELECT id FROM usernames)
+        """
+    )
+    db.add_search_queries({f"tag{i}": "hashtag" for i in range(1000)})
+    conn.executemany(
+        """
+        UPDATE search_queries
+        SET requests = ?, new_ids = ?, next_page = ?, exhausted = ?, last_run = ?
+        WHERE query = ?
+        """,
+        [
+            (
+                requests,
+                rng.randrange(50 * requests + 1),
+                requests,
+                int(rng.random() < 0.3),
+                int(time.time()) - rng.randrange(7 * 86400),
+                f"tag{i}",
+            )
+            for i, requests in enumerate(rng.randrange(20) for _ in range(1000))
+        ],
+    )
+    conn.commit()
+
+
+def benchmarks(db: DB) -> List[Tuple[str, Callable[[], None]]]:
+    (num_ltks,) = db.connection.execute("SELECT max(rowid) FROM ltks").fetchone()
+    rng = random.Random(1)
+    ltk_ids = [f"l{rng.randrange(num_ltks)}" for _ in range(1000)]
+    ltk_ids += [f"new-l{i}" for i in range(1000)]
+    product_ids = [f"p{rng.randrange(num_ltks)}-0" for _ in range(1000)]
+    product_ids += [f"new-p{i}" for i in range(1000)]
+    user_ids = [f"user{i}" for i in range(100)]
+    products = db.get_products(product_ids[:1000])
+    ltks = db.get_ltks(ltk_ids[:1000])
+    upserted = [0]
+
+    def upsert_products():
+        upserted[0] += 1
+        db.upsert_products(
+            [replace(x, id=f"bench{upserted[0]}-{x.id}") for x in products]
+        )
+
+    def upsert_ltks():
+        upserted[0] += 1
+        db.upsert_ltks([replace(x, id=f"bench{upserted[0]}-{x.id}") for x in ltks])
+
+    return [
+        ("unvisited_ltks", lambda: db.unvisited_ltks(50)),
+        ("unvisited_ltk_candidates", lambda: db.unvisited_ltk_candidates(2500)),
+        (
+            "unvisited_ltk_candidates_sweep",
+            lambda: db.unvisited_ltk_candidates(2500, after_rowid=num_ltks // 2),
+        ),
+        ("missing_images_product", lambda: db.missing_images("product", 1000)),
+        (
+            "missing_images_product_with_price",
+            lambda: db.missing_images("product", 1000, only_with_price=True),
+        ),
+        (
+            "missing_images_product_with_name",
+            lambda: db.missing_images("product", 1000, only_with_name=True),
+        ),
+        (
+            "missing_images_product_recent",
+            lambda: db.missing_images("product", 1000, sort_by_recent=True),
+        ),
+        ("missing_images_ltk", lambda: db.missing_images("ltk", 1000)),
+        (
+            "missing_images_product_backlog",
+            lambda: sum(1 for _ in db.iter_missing_images("product")),
+        ),
+        (
+            "missing_images_ltk_backlog",
+            lambda: sum(1 for _ in db.iter_missing_images("ltk")),
+        ),
+        (
+            "missing_images_product_page",
+            lambda: db.missing_images("product", 1000, after_id="p5"),
+        ),
+        (
+            "missing_images_ltk_page",
+            lambda: db.missing_images("ltk", 1000, after_id="l5"),
+        ),
+        ("missing_videos", lambda: db.missing_videos(1000)),
+        ("missing_usernames", lambda: db.missing_usernames(50)),
+        (
+            "missing_usernames_page",
+            lambda: db.missing_usernames(1000, after_id="user5"),
+        ),
+        ("profile_id_counts", lambda: db.profile_id_counts()),
+        ("unresolved_profiles", lambda: db.unresolved_profiles(user_ids)),
+        (
+            "profile_ltks",
+            lambda: [list(db.iter_profile_ltks(x, limit=10)) for x in user_ids],
+        ),
+        ("unscraped_ltks", lambda: db.unscraped_ltks(ltk_ids)),
+        ("unscraped_products", lambda: db.unscraped_products(product_ids)),
+        ("get_products", lambda: db.get_products(product_ids)),
+        ("get_ltks", lambda: db.get_ltks(ltk_ids)),
+        ("has_visited_ltk", lambda: [db.has_visited_ltk(x) for x in ltk_ids[:100]]),
+        ("image_ids", lambda: list(zip(range(1000), db.iter_image_ids("product")))),
+        (
+            "products_in_price_range",
+            lambda: list(
+                db.iter_products_in_price_range(
+                    50, 60, category="shoes", limit=1000
+                )
+            ),
+        ),
+        ("top_categories", lambda: db.top_categories(50)),
+        ("top_retailers", lambda: db.top_retailers(200)),
+        ("recent_captions", lambda: sum(1 for _ in db.iter_recent_captions(100000))),
+        ("next_search_queries", lambda: db.next_search_queries(8)),
+        (
+            "changes_since",
+            lambda: list(db.changes_since(db.latest_change_seq() - 1000)),
+        ),
+        ("upsert_products", upsert_products),
+        ("upsert_ltks", upsert_ltks),
+    ]
+
+
+def check_plans(db_path: str, trace_path: str) -> List[Tuple[str, List[str]]]:
+    """
+    Run every benchmark once with SQL tracing, returning the benchmarks
+    which performed full scans outside of ALLOWED_SCANS.
+    """
+    old_trace = os.environ.get(SQL_TRACE_ENV)
+    os.environ[SQL_TRACE_ENV] = trace_path
+    try:
+        db = DB(db_path)
+        failures = []
+        for name, fn in benchmarks(db):
+            if os.path.exists(trace_path):
+                os.remove(trace_path)
+            fn()
+            scans = []
+            with open(trace_path, "r") as f:
+                for line in f:
+                    scans.extend(json.loads(line).get("full_scans", []))
+            allowed = ALLOWED_SCANS.get(name, [])
+            unexpected = [x for x in scans if x.split()[-1] not in allowed]
+            if unexpected:
+                failures.append((name, unexpected))
+        return failures
+    finally:
+        if old_trace is None:
+            del os.environ[SQL_TRACE_ENV]
+        else:
+            os.environ[SQL_TRACE_ENV] = old_trace
+
+
+if __name__ == "__main__":
+    main()
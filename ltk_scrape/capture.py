@@ -0,0 +1,116 @@
+"""
+Append-only logs of raw scraped payloads, so that the database can be
+rebuilt after decoding or schema changes without scraping again.
+
+A log is a directory of gzip-compressed JSON-lines segments. Every process
+writes its own segments, and a segment is closed once it has received a
+fixed number of uncompressed bytes.
+
+Each record holds its capture time with millisecond resolution and a
+sequence number within its process, so that segments written concurrently
+by several processes can be merged back into capture order.
+"""
+
+import gzip
+import json
+import os
+import time
+import zlib
+from threading import Lock
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+
+class CaptureLog:
+    def __init__(self, directory: str, segment_bytes: int = 2**26):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self._lock = Lock()
+        self._file: Optional[gzip.GzipFile] = None
+        self._written = 0
+        self._num_segments = 0
+        self._seq = 0
+        self._prefix = f"{int(time.time() * 1000):013d}-{os.getpid()}"
+
+    def __del__(self):
+        self.close()
+
+    def append(self, kind: str, payload: Any):
+        with self._lock:
+            # Stamp records under the lock, so that their order in the file
+            # matches their sequence numbers.
+            line = json.dumps(
+                dict(
+                    kind=kind,
+                    captured_at=round(time.time(), 3),
+                    seq=self._seq,
+                    payload=payload,
+                )
+            ).encode("utf-8")
+            self._seq += 1
+            if self._file is None:
+                name = f"{self._prefix}-{self._num_segments:05d}.jsonl.gz"
+                self._file = gzip.open(os.path.join(self.directory, name), "wb")
+                self._num_segments += 1
+                self._written = 0
+            self._file.write(line + b"\n")
+            # Flush so that records survive if the scraper is killed.
+            self._file.flush()
+            self._written += len(line) + 1
+            if self._written >= self.segment_bytes:
+                self._file.close()
+                self._file = None
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def list_segments(directory: str) -> List[str]:
+    """
+    List segment paths grouped by the process which wrote them, and in the
+    order each process wrote them. Segments of different processes may
+    overlap in time; see segment_streams().
+    """
+    return [
+        os.path.join(directory, name)
+        for name in sorted(os.listdir(directory))
+        if name.endswith(".jsonl.gz")
+    ]
+
+
+def segment_streams(directory: str) -> List[List[str]]:
+    """
+    Group segment paths by the process which wrote them. Records within
+    each group are in capture order.
+    """
+    streams: Dict[str, List[str]] = {}
+    for path in list_segments(directory):
+        prefix = os.path.basename(path).rsplit("-", 1)[0]
+        streams.setdefault(prefix, []).append(path)
+    return list(streams.values())
+
+
+def record_key(record: Dict[str, Any]) -> Tuple[float, int]:
+    """
+    Get a (captured_at, seq) key which orders the records of one process.
+    Records from before sequence numbers were added only have a time.
+    """
+    return record["captured_at"], record.get("seq", 0)
+
+
+def read_segment(path: str) -> Iterator[Dict[str, Any]]:
+    """
+    Read the records of a segment, ignoring a truncated final record from a
+    process which did not close its segment.
+    """
+    with gzip.open(path, "rb") as f:
+        try:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                yield json.loads(line)
+        except (EOFError, zlib.error):
+            pass
@@ -1,13 +1,11 @@
 import json
+import os
 import shutil
-from dataclasses import dataclass
-from typing import Dict, Optional
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, List, Optional
 from datetime import datetime
 
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.chrome.service import Service
-
+from .capture import CaptureLog
 from .db import LTK, Product, ProductDetails
 
 
@@ -16,9 +14,29 @@ class LTKPost:
     ltks: Dict[str, LTK]
     products: Dict[str, Product]
 
+    # Maps profile_user_id to username for profiles found on the page.
+    usernames: Dict[str, str] = field(default_factory=dict)
+
 
 class LTKClient:
-    def __init__(self, proxy: Optional[str] = None):
+    def __init__(
+        self,
+        proxy: Optional[str] = None,
+        page_timeout: float = 30.0,
+        capture: Optional[CaptureLog] = None,
+    ):
+        # Stays set until a browser exists, so that close() and __del__ have
+        # nothing to clean up if startup fails.
+        self.closed = True
+
+        # Selenium is only needed once a browser is started, and the decoding
+        # helpers in this module are imported by many other entry points.
+        from selenium import webdriver
+        from selenium.webdriver.chrome.options import Options
+        from selenium.webdriver.chrome.service import Service
+
+        self.capture = capture
+
         options = Options()
         options.add_argument("--headless")
         options.add_argument("--disable-gpu")
@@ -28,9 +46,38 @@ class LTKClient:
 
         service = Service(shutil.which("chromedriver"))
         self.driver = webdriver.Chrome(service=service, options=options)
+        self.closed = False
+        self.driver.set_page_load_timeout(page_timeout)
+        self.driver.set_script_timeout(page_timeout)
 
     def __del__(self):
-        self.driver.quit()
+        self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.driver.quit()
+        except Exception:
+            # The browser may have already crashed, in which case there is
+            # nothing left to clean up besides the service process.
+            self.driver.service.stop()
+
+    def is_healthy(self) -> bool:
+        """Check that the browser is still responding to commands."""
+        try:
+            return self.driver.execute_script("return 1;") == 1
+        except Exception:
+            return False
+
+    def rss_bytes(self) -> int:
+        """
+        Get the total resident memory of chromedriver and every browser
+        process it spawned. Returns 0 where /proc is unavailable.
+        """
+        root = self.driver.service.process.pid
+        return sum(_proc_rss(pid) for pid in _proc_descendants(root))
 
     def fetch_post(self, post_url: str) -> LTKPost:
         self.driver.get(post_url)
@@ -54,70 +101,163 @@ class LTKClient:
         product_details_json = self.driver.execute_script(script)
         product_details_data = json.loads(product_details_json)
 
-        ltks = {
-            ltk_id: LTK(
-                id=ltk_id,
-                hero_image=data["heroImage"],
-                hero_image_width=data["heroImageWidth"],
-                hero_image_height=data["heroImageHeight"],
-                video_url=media_objects.get(data.get("videoMediaId"), {}).get(
-                    "mediaCdnUrl"
+        script = (
+            "return JSON.stringify((__NUXT__.state.profiles || {}).profiles || {});"
+        )
+        profiles_json = self.driver.execute_script(script)
+        profiles_data = json.loads(profiles_json)
+
+        if self.capture is not None:
+            self.capture.append(
+                "nuxt",
+                dict(
+                    url=post_url,
+                    ltks=ltks_data,
+                    products=products_data,
+                    media_objects=media_objects,
+                    product_details=product_details_data,
+                    profiles=profiles_data,
                 ),
-                profile_id=data["profileId"],
-                profile_user_id=data["profileUserId"],
-                status=data["status"],
-                caption=data["caption"],
-                share_url=data["shareUrl"],
-                date_created=parse_timestamp(data["dateCreated"]),
-                date_updated=parse_timestamp(data["dateUpdated"]),
-                date_published=parse_timestamp(data["datePublished"]),
-                product_ids=data.get("productIds", []),
-                fetched_at=data["fetchedAt"],
-            )
-            for ltk_id, data in ltks_data.items()
-        }
-
-        product_details = {
-            id: ProductDetails(
-                id=data["id"],
-                name=data["name"],
-                advertiser_name=data["advertiserName"],
-                advertiser_parent_id=data["advertiserParentId"],
-                price=maybe_parse_float(data["price"]),
-                local_price=maybe_parse_float(data["localPrice"]),
-                currency=data["currency"],
-                retailer_id=data["retailerId"],
-                retailer_ids=data["retailerIds"],
-                min_price=data["minPrice"],
-                min_sale_price=data["minSalePrice"],
-                max_price=data["maxPrice"],
-                max_sale_price=data["maxSalePrice"],
-                top_level_category=data["topLevelCategory"],
             )
-            for id, data in product_details_data.items()
-        }
-
-        products = {
-            product_id: Product(
-                id=product_id,
-                ltk_id=data["ltkId"],
-                hyperlink=data["hyperlink"],
-                image_url=data["imageUrl"],
-                retailer_display_name=data["retailerDisplayName"],
-                retailer_id=data["retailerId"],
-                fetched_at=data["fetchedAt"],
-                details=product_details.get(data["productDetailsId"]),
-            )
-            for product_id, data in products_data.items()
-        }
 
-        return LTKPost(ltks=ltks, products=products)
+        return decode_nuxt_state(
+            ltks_data, products_data, media_objects, product_details_data, profiles_data
+        )
+
+
+def decode_nuxt_state(
+    ltks_data: Dict[str, Any],
+    products_data: Dict[str, Any],
+    media_objects: Dict[str, Any],
+    product_details_data: Dict[str, Any],
+    profiles_data: Dict[str, Any],
+) -> LTKPost:
+    """Decode the state objects extracted from a post's page."""
+    ltks = {
+        ltk_id: LTK(
+            id=ltk_id,
+            hero_image=data["heroImage"],
+            hero_image_width=data["heroImageWidth"],
+            hero_image_height=data["heroImageHeight"],
+            video_url=media_objects.get(data.get("videoMediaId"), {}).get(
+                "mediaCdnUrl"
+            ),
+            profile_id=data["profileId"],
+            profile_user_id=data["profileUserId"],
+            status=data["status"],
+            caption=data["caption"],
+            share_url=data["shareUrl"],
+            date_created=parse_timestamp(data["dateCreated"]),
+            date_updated=parse_timestamp(data["dateUpdated"]),
+            date_published=parse_timestamp(data["datePublished"]),
+            product_ids=data.get("productIds", []),
+            fetched_at=data["fetchedAt"],
+        )
+        for ltk_id, data in ltks_data.items()
+    }
+
+    product_details = {
+        id: ProductDetails(
+            id=data["id"],
+            name=data["name"],
+            advertiser_name=data["advertiserName"],
+            advertiser_parent_id=data["advertiserParentId"],
+            price=maybe_parse_float(data["price"]),
+            local_price=maybe_parse_float(data["localPrice"]),
+            currency=data["currency"],
+            retailer_id=data["retailerId"],
+            retailer_ids=data["retailerIds"],
+            min_price=maybe_parse_float(data["minPrice"]),
+            min_sale_price=maybe_parse_float(data["minSalePrice"]),
+            max_price=maybe_parse_float(data["maxPrice"]),
+            max_sale_price=maybe_parse_float(data["maxSalePrice"]),
+            top_level_category=data["topLevelCategory"],
+        )
+        for id, data in product_details_data.items()
+    }
+
+    products = {
+        product_id: Product(
+            id=product_id,
+            ltk_id=data["ltkId"],
+            hyperlink=data["hyperlink"],
+            image_url=data["imageUrl"],
+            retailer_display_name=data["retailerDisplayName"],
+            retailer_id=data["retailerId"],
+            fetched_at=data["fetchedAt"],
+            details=product_details.get(data["productDetailsId"]),
+        )
+        for product_id, data in products_data.items()
+    }
+
+    return LTKPost(
+        ltks=ltks,
+        products=products,
+        usernames=harvest_usernames(
+            ltks.values(), profiles_data.values(), name_key="displayName"
+        ),
+    )
+
+
+def harvest_usernames(
+    ltks: Iterable[LTK], profiles: Iterable[Dict[str, Any]], name_key: str
+) -> Dict[str, str]:
+    """
+    Map profile_user_id to username using profile objects which were
+    included alongside some posts, so that they need not be resolved through
+    share URL redirects later.
+
+    Profile objects are keyed by profile_id, so only profiles with at least
+    one of the given posts can be mapped.
+    """
+    user_ids = {ltk.profile_id: ltk.profile_user_id for ltk in ltks}
+    result = {}
+    for profile in profiles:
+        user_id = user_ids.get(profile.get("id"))
+        username = profile.get(name_key)
+        if user_id and username:
+            result[user_id] = username
+    return result
+
+
+def _proc_descendants(root: int) -> List[int]:
+    children = {}
+    try:
+        pids = [int(x) for x in os.listdir("/proc") if x.isdigit()]
+    except FileNotFoundError:
+        return []
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/stat", "r") as f:
+                # The command name may contain spaces, so split after it.
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(pid)
+    result = []
+    stack = [root]
+    while stack:
+        pid = stack.pop()
+        result.append(pid)
+        stack.extend(children.get(pid, []))
+    return result
+
+
+def _proc_rss(pid: int) -> int:
+    try:
+        with open(f"/proc/{pid}/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return 0
 
 
-def maybe_parse_float(x: str) -> Optional[float]:
+def maybe_parse_float(x: Optional[str]) -> Optional[float]:
     try:
         return float(x)
-    except ValueError:
+    except (TypeError, ValueError):
         return None
 
 
@@ -1,40 +1,32 @@
 """
 I accidentally inserted dates as strings instead of epoch integers.
 
-This script corrects for that.
+This script corrects for that. The fix is now migration 1 in migrate.py,
+which runs in small resumable chunks; this entry point only runs that one
+migration.
 """
 
-from tqdm.auto import tqdm
-import sqlite3
 import argparse
-from .client import parse_timestamp
+
+from .db import DB
+from .migrate import MIGRATIONS, run_migration
+from .profiling import add_profiling_args, enable_profiling
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--db_path", type=str, default="db.db")
+    parser.add_argument("--chunk_size", type=int, default=10000)
+    parser.add_argument("--sleep", type=float, default=0.05)
+    add_profiling_args(parser)
     args = parser.parse_args()
+    enable_profiling(args)
 
-    db = sqlite3.connect(args.db_path)
-    print("reading rows...")
-    all_rows = db.execute(
-        "SELECT id, date_created, date_updated, date_published FROM ltks"
-    ).fetchall()
-    print("converting...")
-    cursor = db.cursor()
-    for id, date_created, date_updated, date_published in tqdm(all_rows):
-        date_created = parse_timestamp(date_created)
-        date_updated = parse_timestamp(date_updated)
-        date_published = parse_timestamp(date_published)
-        cursor.execute(
-            """
-            UPDATE ltks
-            SET date_created = ?, date_updated = ?, date_published = ?
-            WHERE id = ?
-            """,
-            (date_created, date_updated, date_published, id),
-        )
-    db.commit()
+    db = DB(args.db_path)
+    (migration,) = [x for x in MIGRATIONS if x.name == "convert_dates"]
+    run_migration(
+        db.connection, migration, chunk_size=args.chunk_size, sleep=args.sleep
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,64 @@
+"""
+Load currency conversion rates and recompute the USD-normalized price of
+every product.
+
+The rates file is a JSON object mapping each currency code to the USD
+value of one unit, e.g. {"USD": 1.0, "EUR": 1.08}.
+"""
+
+import argparse
+import json
+import sqlite3
+
+from .db import DB
+from .migrate import run_chunked
+from .profiling import add_profiling_args, enable_profiling
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db_path", type=str, default="db.db")
+    parser.add_argument("--rates_path", type=str, required=True)
+    parser.add_argument("--chunk_size", type=int, default=10000)
+    parser.add_argument("--sleep", type=float, default=0.05)
+    add_profiling_args(parser)
+    args = parser.parse_args()
+    enable_profiling(args)
+
+    with open(args.rates_path, "r") as f:
+        rates = json.load(f)
+
+    db = DB(args.db_path)
+    db.set_currency_rates(rates)
+    print("updating normalized prices...")
+    run_chunked(
+        db.connection,
+        "products",
+        _update_prices,
+        chunk_size=args.chunk_size,
+        sleep=args.sleep,
+    )
+
+
+def _update_prices(conn: sqlite3.Connection, lo: int, hi: int):
+    # Skipping unchanged prices keeps repeated refreshes out of the change
+    # feed, since every updated row is recorded there.
+    conn.execute(
+        """
+        UPDATE products
+        SET price_usd = price * (
+            SELECT usd_rate FROM currency_rates
+            WHERE currency_rates.currency = products.currency
+        )
+        WHERE rowid > ? AND rowid <= ?
+            AND price_usd IS NOT price * (
+                SELECT usd_rate FROM currency_rates
+                WHERE currency_rates.currency = products.currency
+            )
+        """,
+        (lo, hi),
+    )
+
+
+if __name__ == "__main__":
+    main()
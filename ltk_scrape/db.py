@@ -1,12 +1,45 @@
-import json
 import random
 import sqlite3
 import time
 from dataclasses import asdict, dataclass
-from typing import Callable, Dict, List, Literal, Optional, Tuple
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Literal,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+from .bloom import BloomFilter
+from .profiling import connect
 
 ImageSource = Literal["product", "ltk"]
 
+# Stay below SQLITE_MAX_VARIABLE_NUMBER, which is 999 in older builds.
+MAX_QUERY_VARIABLES = 900
+
+# Stored in PRAGMA user_version once _initialize_tables() has run. Bump this
+# whenever that method changes, so that existing databases run it again.
+SCHEMA_VERSION = 6
+
+# The migration in migrate.py which fills in the profiles table for posts
+# stored before it existed.
+PROFILES_BACKFILL_VERSION = 4
+
+# Tables whose inserts, updates and deletes are recorded in the changes table.
+CHANGE_TABLES = [
+    "ltks",
+    "products",
+    "usernames",
+    "product_images",
+    "ltk_hero_images",
+    "ltk_videos",
+]
+
 
 @dataclass
 class ProductDetails:
@@ -19,10 +52,10 @@ class ProductDetails:
     currency: str
     retailer_id: str
     retailer_ids: List[str]
-    min_price: str
-    min_sale_price: str
-    max_price: str
-    max_sale_price: str
+    min_price: Optional[float]
+    min_sale_price: Optional[float]
+    max_price: Optional[float]
+    max_sale_price: Optional[float]
     top_level_category: str
 
 
@@ -57,6 +90,124 @@ class LTK:
     fetched_at: int
 
 
+PRODUCT_COLUMNS = """
+    id, ltk_id, hyperlink, image_url, retailer_display_name, fetched_at,
+    details_id, name, advertiser_name, advertiser_parent_id, price,
+    local_price, currency, retailer_id, retailer_ids, min_price,
+    min_sale_price, max_price, max_sale_price, top_level_category
+"""
+
+LTK_COLUMNS = """
+    id, hero_image, hero_image_width, hero_image_height, video_url, profile_id,
+    profile_user_id, status, caption, share_url, date_created,
+    date_updated, date_published, product_ids, fetched_at
+"""
+
+
+def create_products_table(connection: sqlite3.Connection, name: str = "products"):
+    connection.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS {name} (
+            id TEXT PRIMARY KEY,
+            ltk_id TEXT,
+            hyperlink TEXT,
+            image_url TEXT,
+            retailer_display_name TEXT,
+            fetched_at INTEGER,
+            details_id TEXT,
+            name TEXT,
+            advertiser_name TEXT,
+            advertiser_parent_id TEXT,
+            price REAL,
+            local_price REAL,
+            currency TEXT,
+            retailer_id TEXT,
+            retailer_ids TEXT,
+            min_price REAL,
+            min_sale_price REAL,
+            max_price REAL,
+            max_sale_price REAL,
+            top_level_category TEXT,
+            price_usd REAL  -- price converted with currency_rates
+        );
+        """
+    )
+
+
+def create_products_indexes(connection: sqlite3.Connection):
+    # Covers missing image scans, with or without the price filter.
+    connection.execute(
+        "CREATE INDEX IF NOT EXISTS idx_products_image_url_price ON products(id, price, image_url);"
+    )
+    if products_have_typed_prices(connection):
+        # Until migrate.py converts an old table, these would index text.
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS idx_products_price_usd ON products(price_usd);"
+        )
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS idx_products_category_price ON products(top_level_category, price_usd);"
+        )
+
+
+def create_ltks_indexes(connection: sqlite3.Connection):
+    # Only a small fraction of posts have videos.
+    connection.execute(
+        "CREATE INDEX IF NOT EXISTS idx_ltks_video_url ON ltks(id, video_url) WHERE video_url IS NOT NULL;"
+    )
+    connection.execute(
+        "CREATE INDEX IF NOT EXISTS idx_ltks_profile_user_id ON ltks(profile_user_id, date_published);"
+    )
+
+
+def products_have_typed_prices(connection: sqlite3.Connection) -> bool:
+    for row in connection.execute("PRAGMA table_info(products)"):
+        if row[1] == "min_price":
+            return row[2].upper() == "REAL"
+    return False
+
+
+def create_migrations_table(connection: sqlite3.Connection):
+    connection.execute(
+        """
+        CREATE TABLE IF NOT EXISTS migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT,
+            last_rowid INTEGER,
+            completed_at INTEGER
+        );
+        """
+    )
+
+
+def create_change_triggers(connection: sqlite3.Connection, table: str):
+    """
+    Record every insert, update and delete of the table in the changes table.
+    This happens inside the writer's transaction, so the feed never misses or
+    invents a write. Without PRAGMA recursive_triggers, INSERT OR REPLACE
+    only fires the insert trigger, so a replaced row is recorded as an insert.
+
+    Existing triggers are replaced, since older versions did not record ops.
+    """
+    for event, row in [("INSERT", "NEW"), ("UPDATE", "NEW"), ("DELETE", "OLD")]:
+        name = f"trg_{table}_{event.lower()}_changes"
+        connection.execute(f"DROP TRIGGER IF EXISTS {name};")
+        connection.execute(
+            f"""
+            CREATE TRIGGER {name}
+            AFTER {event} ON {table}
+            BEGIN
+                INSERT INTO changes (table_name, row_id, op, changed_at)
+                VALUES (
+                    '{table}',
+                    {row}.id,
+                    '{event.lower()}',
+                    CAST(strftime('%s', 'now') AS INTEGER)
+                );
+            END;
+            """
+        )
+
+
 def retry_if_busy(fn: Callable) -> Callable:
     def new_fn(*args, **kwargs):
         while True:
@@ -74,11 +225,38 @@ def retry_if_busy(fn: Callable) -> Callable:
 
 class DB:
     def __init__(self, filename: str):
-        self.connection = sqlite3.connect(filename)
+        self.connection = connect(filename)
+        self.id_filters: Dict[str, BloomFilter] = {}
+        self._profiles_backfilled = False
         self._initialize_tables()
 
+    def enable_id_filters(self, error_rate: float = 0.01, headroom: float = 2.0):
+        """
+        Load every ltk and product id into in-memory Bloom filters, so that
+        unscraped_ltks() and unscraped_products() only need to query the
+        database for ids which might already be known.
+
+        The filters are only updated by upserts through this object. Rows
+        written by other processes may be reported as unscraped, which is
+        harmless since upserts replace existing rows.
+        """
+        for table in ["ltks", "products"]:
+            max_rowid = self.connection.execute(
+                f"SELECT max(rowid) FROM {table}"
+            ).fetchone()[0]
+            id_filter = BloomFilter(
+                int((max_rowid or 0) * headroom) + 100000, error_rate=error_rate
+            )
+            id_filter.update(
+                row[0] for row in self._iter_query(f"SELECT id FROM {table}", ())
+            )
+            self.id_filters[table] = id_filter
+
     @retry_if_busy
     def _initialize_tables(self):
+        (version,) = self.connection.execute("PRAGMA user_version;").fetchone()
+        if version >= SCHEMA_VERSION:
+            return
         self.connection.execute(
             """
             CREATE TABLE IF NOT EXISTS ltks (
@@ -96,10 +274,15 @@ class DB:
                 date_updated INTEGER,  -- Store as epoch time
                 date_published INTEGER,  -- Store as epoch time
                 product_ids TEXT,  -- Comma-separated or JSON string
-                fetched_at INTEGER
+                fetched_at INTEGER,  -- As reported upstream
+                found_at INTEGER  -- Epoch time we first stored the post
             );
             """
         )
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(ltks)")]
+        if "found_at" not in columns:
+            # Posts stored before this column existed keep NULL.
+            self.connection.execute("ALTER TABLE ltks ADD COLUMN found_at INTEGER;")
         self.connection.execute(
             """
             CREATE TABLE IF NOT EXISTS usernames (
@@ -109,29 +292,19 @@ class DB:
             );
             """
         )
+        create_products_table(self.connection)
+        columns = [
+            row[1] for row in self.connection.execute("PRAGMA table_info(products)")
+        ]
+        if "price_usd" not in columns:
+            # Databases which predate typed prices get this column right away,
+            # and the rest of the table is converted by a migration.
+            self.connection.execute("ALTER TABLE products ADD COLUMN price_usd REAL;")
         self.connection.execute(
             """
-            CREATE TABLE IF NOT EXISTS products (
-                id TEXT PRIMARY KEY,
-                ltk_id TEXT,
-                hyperlink TEXT,
-                image_url TEXT,
-                retailer_display_name TEXT,
-                fetched_at INTEGER,
-                details_id TEXT,
-                name TEXT,
-                advertiser_name TEXT,
-                advertiser_parent_id TEXT,
-                price REAL,
-                local_price REAL,
-                currency TEXT,
-                retailer_id TEXT,
-                retailer_ids TEXT,
-                min_price TEXT,
-                min_sale_price TEXT,
-                max_price TEXT,
-                max_sale_price TEXT,
-                top_level_category TEXT
+            CREATE TABLE IF NOT EXISTS currency_rates (
+                currency TEXT PRIMARY KEY,
+                usd_rate REAL  -- Value of one unit of the currency in USD
             );
             """
         )
@@ -161,26 +334,125 @@ class DB:
             );
             """
         )
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS ltk_videos (
+                id TEXT PRIMARY KEY,
+                path TEXT,  -- Relative to the download directory
+                size INTEGER,
+                sha256 TEXT,
+                error TEXT
+            );
+            """
+        )
+        for table in ["product_image_hashes", "ltk_hero_image_hashes"]:
+            self.connection.execute(
+                f"""
+                CREATE TABLE IF NOT EXISTS {table} (
+                    id TEXT PRIMARY KEY,
+                    phash INTEGER,  -- 64-bit DCT hash, stored as a signed integer
+                    group_id TEXT,  -- Smallest id among near-duplicates, if any
+                    error TEXT
+                );
+                """
+            )
+        profiles_existed = self.connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'profiles'"
+        ).fetchone()
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS profiles (
+                id TEXT PRIMARY KEY,  -- profile_user_id
+                profile_id TEXT,
+                post_count INTEGER,
+                share_url TEXT,  -- Any post's share URL, for resolving usernames
+                username_status TEXT  -- NULL (unresolved), 'found', or 'error'
+            );
+            """
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS idx_profiles_username_status ON profiles(username_status);"
+        )
         self.connection.execute(
             "CREATE INDEX IF NOT EXISTS idx_product_images_error_id ON product_images (error, id);"
         )
         self.connection.execute(
             "CREATE INDEX IF NOT EXISTS idx_ltk_hero_images_error_id ON ltk_hero_images (error, id);"
         )
+        # Leads with the primary key, but lets missing hero image scans skip
+        # over captions and other wide columns.
         self.connection.execute(
             "CREATE INDEX IF NOT EXISTS idx_ltks_id_hero_image ON ltks(id, hero_image);"
         )
-        self.connection.execute(
-            "CREATE INDEX IF NOT EXISTS idx_products_image_url ON products(id, image_url);"
+        # Indexing a large existing table is left to migrate.py, so that
+        # opening the database never blocks scrapers on it.
+        ltks_empty = (
+            self.connection.execute("SELECT 1 FROM ltks LIMIT 1").fetchone() is None
         )
+        if ltks_empty:
+            create_ltks_indexes(self.connection)
+        create_products_indexes(self.connection)
         self.connection.execute(
-            "CREATE INDEX IF NOT EXISTS idx_products_image_url_price ON products(id, price, image_url);"
+            """
+            CREATE TABLE IF NOT EXISTS changes (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,  -- Never reused after pruning
+                table_name TEXT NOT NULL,
+                row_id TEXT NOT NULL,
+                op TEXT,  -- 'insert', 'update' or 'delete'; NULL in old rows
+                changed_at INTEGER NOT NULL  -- Store as epoch time
+            );
+            """
         )
+        columns = [
+            row[1] for row in self.connection.execute("PRAGMA table_info(changes)")
+        ]
+        if "op" not in columns:
+            self.connection.execute("ALTER TABLE changes ADD COLUMN op TEXT;")
+        for table in CHANGE_TABLES:
+            create_change_triggers(self.connection, table)
         self.connection.execute(
-            "CREATE INDEX IF NOT EXISTS idx_ltks_user_id ON ltks(share_url, profile_user_id);"
+            """
+            CREATE TABLE IF NOT EXISTS search_queries (
+                query TEXT PRIMARY KEY,
+                source TEXT,  -- 'hashtag', 'category' or 'retailer'
+                requests INTEGER,
+                new_ids INTEGER,  -- Unknown post ids found by all requests
+                next_page INTEGER,  -- First page not yet backfilled
+                exhausted INTEGER,  -- 1 once backfilling reached an empty page
+                last_run INTEGER  -- Store as epoch time
+            );
+            """
         )
+        create_migrations_table(self.connection)
+        if profiles_existed or ltks_empty:
+            # Profiles are complete unless posts were stored before the table
+            # existed, which migrate.py backfills. Older versions of this
+            # method backfilled the table as they created it.
+            self.connection.execute(
+                """
+                INSERT OR IGNORE INTO migrations (
+                    version, name, last_rowid, completed_at
+                ) VALUES (?, 'backfill_profiles', 0, ?);
+                """,
+                (PROFILES_BACKFILL_VERSION, int(time.time())),
+            )
+        self.connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION};")
         self.connection.commit()
 
+    @retry_if_busy
+    def _check_profiles_backfilled(self) -> bool:
+        """
+        Check whether every stored post is reflected in the profiles table.
+        Until migrate.py has backfilled it, queries aggregate ltks instead.
+        """
+        if not self._profiles_backfilled:
+            row = self.connection.execute(
+                "SELECT completed_at FROM migrations WHERE version = ?",
+                (PROFILES_BACKFILL_VERSION,),
+            ).fetchone()
+            self._profiles_backfilled = row is not None and row[0] is not None
+        return self._profiles_backfilled
+
     @retry_if_busy
     def upsert_products(self, products: List[Product]):
         cursor = self.connection.cursor()
@@ -215,148 +487,281 @@ class DB:
                     id, ltk_id, hyperlink, image_url, retailer_display_name, fetched_at,
                     details_id, name, advertiser_name, advertiser_parent_id, price,
                     local_price, currency, retailer_id, retailer_ids, min_price,
-                    min_sale_price, max_price, max_sale_price, top_level_category
+                    min_sale_price, max_price, max_sale_price, top_level_category,
+                    price_usd
                 )
                 VALUES (
                     :id, :ltk_id, :hyperlink, :image_url, :retailer_display_name, :fetched_at,
                     :details_id, :name, :advertiser_name, :advertiser_parent_id, :price,
                     :local_price, :currency, :retailer_id, :retailer_ids, :min_price,
-                    :min_sale_price, :max_price, :max_sale_price, :top_level_category
+                    :min_sale_price, :max_price, :max_sale_price, :top_level_category,
+                    (SELECT :price * usd_rate FROM currency_rates WHERE currency = :currency)
                 );
                 """,
                 obj,
             )
         self.connection.commit()
+        if "products" in self.id_filters:
+            self.id_filters["products"].update(product.id for product in products)
 
     @retry_if_busy
     def upsert_ltks(self, ltks: List[LTK]):
         cursor = self.connection.cursor()
+        now = int(time.time())
         for ltk in ltks:
             product_ids_str = ",".join(ltk.product_ids)
             ltk_data = asdict(ltk)
             ltk_data["product_ids"] = product_ids_str
+            ltk_data["found_at"] = now
+
+            is_new = (
+                cursor.execute("SELECT 1 FROM ltks WHERE id = ?", (ltk.id,)).fetchone()
+                is None
+            )
+            if ltk.profile_user_id is not None:
+                cursor.execute(
+                    """
+                    INSERT INTO profiles (
+                        id, profile_id, post_count, share_url, username_status
+                    )
+                    VALUES (
+                        :profile_user_id, :profile_id, :is_new, :share_url,
+                        (
+                            SELECT iif(username IS NOT NULL, 'found', 'error')
+                            FROM usernames WHERE id = :profile_user_id
+                        )
+                    )
+                    ON CONFLICT (id) DO UPDATE SET
+                        profile_id = excluded.profile_id,
+                        post_count = post_count + excluded.post_count,
+                        share_url = coalesce(share_url, excluded.share_url);
+                    """,
+                    dict(ltk_data, is_new=int(is_new)),
+                )
 
             cursor.execute(
                 """
                 INSERT OR REPLACE INTO ltks (
                     id, hero_image, hero_image_width, hero_image_height, video_url, profile_id,
                     profile_user_id, status, caption, share_url, date_created,
-                    date_updated, date_published, product_ids, fetched_at
+                    date_updated, date_published, product_ids, fetched_at, found_at
                 )
                 VALUES (
                     :id, :hero_image, :hero_image_width, :hero_image_height, :video_url, :profile_id,
                     :profile_user_id, :status, :caption, :share_url, :date_created,
-                    :date_updated, :date_published, :product_ids, :fetched_at
+                    :date_updated, :date_published, :product_ids, :fetched_at,
+                    coalesce((SELECT found_at FROM ltks WHERE id = :id), :found_at)
                 )
                 """,
                 ltk_data,
             )
         self.connection.commit()
+        if "ltks" in self.id_filters:
+            self.id_filters["ltks"].update(ltk.id for ltk in ltks)
 
-    @retry_if_busy
     def get_products(self, ids: List[str]) -> List[Product]:
-        cursor = self.connection.cursor()
+        return list(self.iter_products(ids))
+
+    def iter_products(
+        self, ids: Optional[List[str]] = None, arraysize: int = 1000
+    ) -> Iterator[Product]:
+        """
+        Iterate over the products with the given ids, or over every product
+        if ids is None.
+        """
+        query = f"SELECT {PRODUCT_COLUMNS} FROM products"
+        if ids is None:
+            rows = self._iter_query(query, (), arraysize=arraysize)
+        else:
+            rows = self._iter_in_query(query + " WHERE id IN ({})", ids, arraysize)
+        for row in rows:
+            yield _product_from_row(row)
+
+    def iter_products_in_price_range(
+        self,
+        min_usd: Optional[float] = None,
+        max_usd: Optional[float] = None,
+        category: Optional[str] = None,
+        limit: Optional[int] = None,
+        arraysize: int = 1000,
+    ) -> Iterator[Product]:
+        """
+        Iterate over products whose USD-normalized price is within the
+        (inclusive) bounds, optionally within one top-level category, in
+        order of increasing price.
+        """
+        clauses = ["price_usd IS NOT NULL"]
+        params = []
+        if category is not None:
+            clauses.append("top_level_category = ?")
+            params.append(category)
+        if min_usd is not None:
+            clauses.append("price_usd >= ?")
+            params.append(min_usd)
+        if max_usd is not None:
+            clauses.append("price_usd <= ?")
+            params.append(max_usd)
         query = f"""
-        SELECT id, ltk_id, hyperlink, image_url, retailer_display_name, fetched_at, 
-            details_id, name, advertiser_name, advertiser_parent_id, price, 
-            local_price, currency, retailer_id, retailer_ids, min_price, 
-            min_sale_price, max_price, max_sale_price, top_level_category
+        SELECT {PRODUCT_COLUMNS}
         FROM products
-        WHERE id IN ({','.join('?' for _ in ids)})
+        WHERE {" AND ".join(clauses)}
+        ORDER BY price_usd
+        LIMIT ?;
         """
-        cursor.execute(query, ids)
-        rows = cursor.fetchall()
+        params.append(_sql_limit(limit))
+        for row in self._iter_query(query, params, arraysize):
+            yield _product_from_row(row)
 
-        products = []
-        for row in rows:
-            (
-                id,
-                ltk_id,
-                hyperlink,
-                image_url,
-                retailer_display_name,
-                fetched_at,
-                details_id,
-                name,
-                advertiser_name,
-                advertiser_parent_id,
-                price,
-                local_price,
-                currency,
-                retailer_id,
-                retailer_ids,
-                min_price,
-                min_sale_price,
-                max_price,
-                max_sale_price,
-                top_level_category,
-            ) = row
-
-            details = None
-            if details_id:
-                details = ProductDetails(
-                    id=details_id,
-                    name=name,
-                    advertiser_name=advertiser_name,
-                    advertiser_parent_id=advertiser_parent_id,
-                    price=price,
-                    local_price=local_price,
-                    currency=currency,
-                    retailer_id=retailer_id,
-                    retailer_ids=json.loads(retailer_ids) if retailer_ids else [],
-                    min_price=min_price,
-                    min_sale_price=min_sale_price,
-                    max_price=max_price,
-                    max_sale_price=max_sale_price,
-                    top_level_category=top_level_category,
-                )
+    @retry_if_busy
+    def set_currency_rates(self, usd_rates: Dict[str, float]):
+        """
+        Store the USD value of one unit of each currency. This only affects
+        products upserted afterwards; use currency_rates.py to also update
+        existing rows.
+        """
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO currency_rates (currency, usd_rate) VALUES (?, ?)",
+            list(usd_rates.items()),
+        )
+        self.connection.commit()
 
-            product = Product(
-                id=id,
-                ltk_id=ltk_id,
-                hyperlink=hyperlink,
-                image_url=image_url,
-                retailer_display_name=retailer_display_name,
-                retailer_id=retailer_id,
-                fetched_at=fetched_at,
-                details=details,
-            )
-            products.append(product)
+    def get_ltks(self, ids: List[str]) -> List[LTK]:
+        return list(self.iter_ltks(ids))
 
-        return products
+    def iter_ltks(
+        self, ids: Optional[List[str]] = None, arraysize: int = 1000
+    ) -> Iterator[LTK]:
+        """
+        Iterate over the posts with the given ids, or over every post if ids
+        is None.
+        """
+        query = f"SELECT {LTK_COLUMNS} FROM ltks"
+        if ids is None:
+            rows = self._iter_query(query, (), arraysize=arraysize)
+        else:
+            rows = self._iter_in_query(query + " WHERE id IN ({})", ids, arraysize)
+        for row in rows:
+            yield _ltk_from_row(row)
 
-    @retry_if_busy
-    def unscraped_ltks(self, ids: List[str]) -> List[str]:
-        if not len(ids):
-            return ids
-        placeholders = ", ".join("(?)" for _ in ids)
+    def iter_profile_ltks(
+        self, profile_user_id: str, limit: Optional[int] = None, arraysize: int = 1000
+    ) -> Iterator[LTK]:
+        """Iterate over the posts of one profile, most recently published first."""
         query = f"""
-        WITH temp(id) AS (
-            VALUES {placeholders}
-        )
-        SELECT temp.id
-        FROM temp
-        WHERE NOT EXISTS (SELECT id FROM ltks WHERE ltks.id = temp.id)
+        SELECT {LTK_COLUMNS} FROM ltks
+        WHERE profile_user_id = ?
+        ORDER BY date_published DESC
+        LIMIT ?
         """
-        result = [row[0] for row in self.connection.execute(query, ids).fetchall()]
-        return result
+        params = (profile_user_id, _sql_limit(limit))
+        for row in self._iter_query(query, params, arraysize):
+            yield _ltk_from_row(row)
+
+    def unscraped_ltks(self, ids: List[str]) -> List[str]:
+        return self._unknown_ids("ltks", ids)
 
-    @retry_if_busy
     def unscraped_products(self, ids: List[str]) -> List[str]:
-        if not len(ids):
-            return ids
-        placeholders = ", ".join("(?)" for _ in ids)
-        query = f"""
-        WITH temp(id) AS (
-            VALUES {placeholders}
-        )
-        SELECT temp.id
-        FROM temp
-        WHERE NOT EXISTS (SELECT id FROM products WHERE products.id = temp.id)
-        """
-        result = [row[0] for row in self.connection.execute(query, ids).fetchall()]
+        return self._unknown_ids("products", ids)
+
+    def _unknown_ids(self, table: str, ids: List[str]) -> List[str]:
+        id_filter = self.id_filters.get(table)
+        if id_filter is not None:
+            # Only ids which pass the filter might already be in the table.
+            maybe_known = [id for id in ids if id in id_filter]
+            unknown = set(self._query_unknown_ids(table, maybe_known))
+            return [id for id in ids if id in unknown or id not in id_filter]
+        return self._query_unknown_ids(table, ids)
+
+    def _query_unknown_ids(self, table: str, ids: List[str]) -> List[str]:
+        result = []
+        for i in range(0, len(ids), MAX_QUERY_VARIABLES):
+            chunk = ids[i : i + MAX_QUERY_VARIABLES]
+            placeholders = ", ".join("(?)" for _ in chunk)
+            query = f"""
+            WITH temp(id) AS (
+                VALUES {placeholders}
+            )
+            SELECT temp.id
+            FROM temp
+            WHERE NOT EXISTS (SELECT id FROM {table} WHERE {table}.id = temp.id)
+            """
+            result.extend(row[0] for row in self._iter_query(query, chunk))
         return result
 
+    def _iter_query(
+        self, query: str, params: Sequence[Any], arraysize: int = 1000
+    ) -> Iterator[Tuple]:
+        """
+        Stream the results of a query in batches of arraysize rows.
+
+        The read transaction stays open until the iterator is exhausted or
+        closed, which can delay writers from other connections. Only the
+        initial execute() is retried while the database is busy: a failed
+        step resets the statement, so a retried fetchmany() would silently
+        end the results early, and errors while fetching are raised instead.
+        """
+        cursor = self.connection.cursor()
+        cursor.arraysize = arraysize
+        retry_if_busy(cursor.execute)(query, params)
+        try:
+            while True:
+                rows = cursor.fetchmany()
+                if not rows:
+                    return
+                yield from rows
+        finally:
+            cursor.close()
+
+    def _iter_in_query(
+        self, query: str, ids: List[str], arraysize: int = 1000
+    ) -> Iterator[Tuple]:
+        """
+        Stream the results of a query with an "IN ({})" placeholder, running
+        it once per chunk of ids to stay below SQLite's variable limit.
+        """
+        for i in range(0, len(ids), MAX_QUERY_VARIABLES):
+            chunk = ids[i : i + MAX_QUERY_VARIABLES]
+            yield from self._iter_query(
+                query.format(",".join("?" for _ in chunk)), chunk, arraysize
+            )
+
+    def changes_since(
+        self,
+        seq: int,
+        tables: Optional[List[str]] = None,
+        limit: Optional[int] = None,
+        arraysize: int = 1000,
+    ) -> Iterator[Tuple[int, str, str, Optional[str]]]:
+        """
+        Iterate over (seq, table_name, row_id, op) tuples of changes after
+        seq, in order, where op is 'insert', 'update' or 'delete' (or None
+        for changes recorded before ops were). A row may appear several
+        times, and may have changed again or been deleted since; consumers
+        should read its current value, and drop their copy if it is gone.
+
+        To copy the database incrementally, start from latest_change_seq()
+        before taking a full copy, then resume from the last seq seen.
+        """
+        query = "SELECT seq, table_name, row_id, op FROM changes WHERE seq > ?"
+        params: List[Any] = [seq]
+        if tables is not None:
+            query += f" AND table_name IN ({','.join('?' for _ in tables)})"
+            params.extend(tables)
+        query += " ORDER BY seq LIMIT ?"
+        params.append(_sql_limit(limit))
+        yield from self._iter_query(query, params, arraysize)
+
+    @retry_if_busy
+    def latest_change_seq(self) -> int:
+        row = self.connection.execute("SELECT max(seq) FROM changes").fetchone()
+        return row[0] or 0
+
+    @retry_if_busy
+    def prune_changes(self, seq: int):
+        """Delete changes up to and including seq, once every consumer has them."""
+        self.connection.execute("DELETE FROM changes WHERE seq <= ?", (seq,))
+        self.connection.commit()
+
     @retry_if_busy
     def has_visited_ltk(self, id: str) -> Tuple[bool, Optional[str]]:
         cursor = self.connection.cursor()
@@ -378,8 +783,13 @@ class DB:
         )
         self.connection.commit()
 
-    @retry_if_busy
     def unvisited_ltks(self, limit: int) -> List[Tuple[str, str]]:
+        return list(self.iter_unvisited_ltks(limit=limit))
+
+    def iter_unvisited_ltks(
+        self, limit: Optional[int] = None, arraysize: int = 1000
+    ) -> Iterator[Tuple[str, str]]:
+        """Iterate over (id, share_url) tuples of posts yet to be visited."""
         query = """
         SELECT ltks.id, ltks.share_url
         FROM ltks
@@ -387,10 +797,57 @@ class DB:
         WHERE visited_ltks.id IS NULL
         LIMIT ?;
         """
-        result = self.connection.execute(query, (limit,)).fetchall()
-        return [tuple(x) for x in result]
+        yield from self._iter_query(query, (_sql_limit(limit),), arraysize)
+
+    @retry_if_busy
+    def unvisited_ltk_candidates(
+        self, limit: int, after_rowid: Optional[int] = None
+    ) -> List[Tuple[int, str, str, Optional[str], Optional[int], int, int, int]]:
+        """
+        Get posts yet to be visited, for crawl scheduling, as tuples (rowid,
+        id, share_url, profile_user_id, date_published, num_products,
+        profile_post_count, found_at). found_at is None for posts stored
+        before it was recorded.
+
+        By default the most recently inserted posts are returned. Otherwise
+        posts are returned in insertion order starting after after_rowid, so
+        that callers can sweep the whole backlog.
+        """
+        if after_rowid is None:
+            where, order = "", "ltks.rowid DESC"
+        else:
+            where, order = "AND ltks.rowid > :after_rowid", "ltks.rowid"
+        query = f"""
+        SELECT
+            ltks.rowid,
+            ltks.id,
+            ltks.share_url,
+            ltks.profile_user_id,
+            ltks.date_published,
+            CASE WHEN ifnull(ltks.product_ids, '') = '' THEN 0
+                ELSE length(ltks.product_ids)
+                    - length(replace(ltks.product_ids, ',', '')) + 1
+            END,
+            ifnull(profiles.post_count, 0),
+            ltks.found_at
+        FROM ltks
+        LEFT JOIN visited_ltks ON ltks.id = visited_ltks.id
+        LEFT JOIN profiles ON profiles.id = ltks.profile_user_id
+        WHERE visited_ltks.id IS NULL {where}
+        ORDER BY {order}
+        LIMIT :limit;
+        """
+        return self.connection.execute(
+            query, dict(limit=limit, after_rowid=after_rowid)
+        ).fetchall()
 
     @retry_if_busy
+    def max_listing_rowid(self, source: ImageSource) -> int:
+        """Get the largest rowid of the products or posts holding source's URLs."""
+        listing_table = "products" if source == "product" else "ltks"
+        query = f"SELECT max(rowid) FROM {listing_table}"
+        return self.connection.execute(query).fetchone()[0] or 0
+
     def missing_images(
         self,
         source: ImageSource,
@@ -398,8 +855,41 @@ class DB:
         only_with_price: bool = False,
         only_with_name: bool = False,
         sort_by_recent: bool = False,
+        after_id: Optional[str] = None,
+        max_rowid: Optional[int] = None,
     ) -> List[Tuple[str, str]]:
         """Get a collection of (id, url) tuples."""
+        return list(
+            self.iter_missing_images(
+                source,
+                limit=limit,
+                only_with_price=only_with_price,
+                only_with_name=only_with_name,
+                sort_by_recent=sort_by_recent,
+                after_id=after_id,
+                max_rowid=max_rowid,
+            )
+        )
+
+    def iter_missing_images(
+        self,
+        source: ImageSource,
+        limit: Optional[int] = None,
+        only_with_price: bool = False,
+        only_with_name: bool = False,
+        sort_by_recent: bool = False,
+        after_id: Optional[str] = None,
+        max_rowid: Optional[int] = None,
+        arraysize: int = 1000,
+    ) -> Iterator[Tuple[str, str]]:
+        """
+        Iterate over (id, url) tuples of images yet to be downloaded. If
+        after_id is given, only ids after it are returned, in id order, so
+        that the backlog can be read in pages. If max_rowid is given, rows
+        inserted after max_listing_rowid() returned it are left out.
+        """
+        if sort_by_recent and after_id is not None:
+            raise ValueError("after_id cannot be combined with sort_by_recent")
 
         image_table = "product_images" if source == "product" else "ltk_hero_images"
         listing_table = "products" if source == "product" else "ltks"
@@ -411,10 +901,18 @@ class DB:
                 where_clauses.append(f"AND {listing_table}.price is not null")
             if only_with_name:
                 where_clauses.append(f"AND {listing_table}.name is not null")
-        where_clause = " AND ".join(where_clauses)
+        params = []
         sort_clause = ""
         if sort_by_recent:
             sort_clause = f"ORDER BY {listing_table}.rowid DESC"
+        if after_id is not None:
+            where_clauses.append(f"AND {listing_table}.id > ?")
+            params.append(after_id)
+            sort_clause = f"ORDER BY {listing_table}.id"
+        if max_rowid is not None:
+            where_clauses.append(f"AND {listing_table}.rowid <= ?")
+            params.append(max_rowid)
+        where_clause = " ".join(where_clauses)
 
         query = f"""
         SELECT {listing_table}.id, {listing_table}.{url_field}
@@ -424,8 +922,8 @@ class DB:
         {sort_clause}
         LIMIT ?;
         """
-        result = self.connection.execute(query, (limit,)).fetchall()
-        return [tuple(x) for x in result]
+        params.append(_sql_limit(limit))
+        yield from self._iter_query(query, params, arraysize)
 
     @retry_if_busy
     def insert_image(
@@ -445,26 +943,321 @@ class DB:
         )
         self.connection.commit()
 
-    @retry_if_busy
-    def missing_usernames(self, limit: int) -> List[Tuple[str, str]]:
+    def missing_videos(self, limit: int) -> List[Tuple[str, str]]:
+        return list(self.iter_missing_videos(limit=limit))
+
+    def iter_missing_videos(
+        self, limit: Optional[int] = None, arraysize: int = 1000
+    ) -> Iterator[Tuple[str, str]]:
+        """Iterate over (id, video_url) tuples of videos yet to be downloaded."""
         query = """
+        SELECT ltks.id, ltks.video_url
+        FROM ltks
+        LEFT JOIN ltk_videos ON ltk_videos.id = ltks.id
+        WHERE ltks.video_url IS NOT NULL AND ltk_videos.id IS NULL
+        LIMIT ?;
+        """
+        yield from self._iter_query(query, (_sql_limit(limit),), arraysize)
+
+    @retry_if_busy
+    def insert_video(
+        self,
+        id: str,
+        path: Optional[str],
+        size: Optional[int],
+        sha256: Optional[str],
+        error: Optional[str] = None,
+    ):
+        self.connection.execute(
+            """
+            INSERT OR REPLACE INTO ltk_videos (id, path, size, sha256, error)
+            VALUES (?, ?, ?, ?, ?);
+            """,
+            (id, path, size, sha256, error),
+        )
+        self.connection.commit()
+
+    @retry_if_busy
+    def clear_video_errors(self):
+        """Forget failed video downloads, so that they are attempted again."""
+        self.connection.execute("DELETE FROM ltk_videos WHERE error IS NOT NULL;")
+        self.connection.commit()
+
+    def iter_image_ids(
+        self, source: ImageSource, page_size: int = 10000
+    ) -> Iterator[str]:
+        """
+        Iterate over the ids of successfully downloaded images in rowid order.
+
+        Ids are read in pages of page_size, each in a separate short read, so
+        that a slow consumer does not hold a read transaction open and block
+        writers. A replaced image moves to a new rowid and may be seen twice.
+        """
+        after_rowid = 0
+        while True:
+            rows = self._image_id_page(source, after_rowid, page_size)
+            if not rows:
+                return
+            for _, id in rows:
+                yield id
+            after_rowid = rows[-1][0]
+
+    @retry_if_busy
+    def _image_id_page(
+        self, source: ImageSource, after_rowid: int, limit: int
+    ) -> List[Tuple[int, str]]:
+        table = "product_images" if source == "product" else "ltk_hero_images"
+        query = f"""
+        SELECT rowid, id FROM {table}
+        WHERE error IS NULL AND rowid > ?
+        ORDER BY rowid
+        LIMIT ?;
+        """
+        return self.connection.execute(query, (after_rowid, limit)).fetchall()
+
+    def get_images(self, source: ImageSource, ids: List[str]) -> Dict[str, bytes]:
+        table = "product_images" if source == "product" else "ltk_hero_images"
+        query = f"SELECT id, data FROM {table} WHERE error IS NULL AND id IN ({{}})"
+        return dict(self._iter_in_query(query, ids))
+
+    @retry_if_busy
+    def missing_image_hashes(
+        self, source: ImageSource, limit: int
+    ) -> List[Tuple[str, bytes]]:
+        """Get a collection of (id, data) tuples for images with no hash."""
+        image_table = "product_images" if source == "product" else "ltk_hero_images"
+        hash_table = image_table[:-1] + "_hashes"
+        query = f"""
+        SELECT {image_table}.id, {image_table}.data
+        FROM {image_table}
+        LEFT JOIN {hash_table} ON {hash_table}.id = {image_table}.id
+        WHERE {hash_table}.id IS NULL AND {image_table}.error IS NULL
+        LIMIT ?;
+        """
+        result = self.connection.execute(query, (limit,)).fetchall()
+        return [tuple(x) for x in result]
+
+    @retry_if_busy
+    def insert_image_hashes(
+        self,
+        source: ImageSource,
+        hashes: List[Tuple[str, Optional[int], Optional[str]]],
+    ):
+        """Insert (id, phash, error) tuples."""
+        table = (
+            "product_image_hashes" if source == "product" else "ltk_hero_image_hashes"
+        )
+        self.connection.executemany(
+            f"INSERT OR REPLACE INTO {table} (id, phash, error) VALUES (?, ?, ?);",
+            hashes,
+        )
+        self.connection.commit()
+
+    def image_hashes(self, source: ImageSource) -> List[Tuple[str, int]]:
+        return list(self.iter_image_hashes(source))
+
+    def iter_image_hashes(
+        self, source: ImageSource, arraysize: int = 10000
+    ) -> Iterator[Tuple[str, int]]:
+        table = (
+            "product_image_hashes" if source == "product" else "ltk_hero_image_hashes"
+        )
+        query = f"SELECT id, phash FROM {table} WHERE phash IS NOT NULL;"
+        yield from self._iter_query(query, (), arraysize)
+
+    @retry_if_busy
+    def set_duplicate_groups(self, source: ImageSource, groups: Dict[str, str]):
+        """
+        Replace all duplicate groups, given a mapping from image id to group
+        id. Images which are not in the mapping have no duplicates.
+        """
+        table = (
+            "product_image_hashes" if source == "product" else "ltk_hero_image_hashes"
+        )
+        cursor = self.connection.cursor()
+        cursor.execute(f"UPDATE {table} SET group_id = NULL;")
+        cursor.executemany(
+            f"UPDATE {table} SET group_id = ? WHERE id = ?;",
+            [(group_id, id) for id, group_id in groups.items()],
+        )
+        self.connection.commit()
+
+    def missing_usernames(
+        self, limit: int, after_id: Optional[str] = None
+    ) -> List[Tuple[str, str]]:
+        return list(self.iter_missing_usernames(limit=limit, after_id=after_id))
+
+    def iter_missing_usernames(
+        self,
+        limit: Optional[int] = None,
+        after_id: Optional[str] = None,
+        arraysize: int = 1000,
+    ) -> Iterator[Tuple[str, str]]:
+        """
+        Iterate over (profile_user_id, share_url) tuples. If after_id is
+        given, only ids after it are returned, in id order.
+        """
+        if not self._check_profiles_backfilled():
+            yield from self._iter_missing_usernames_from_ltks(
+                limit, after_id, arraysize
+            )
+            return
+        where_clause, sort_clause, params = "username_status IS NULL", "", []
+        if after_id is not None:
+            # Walk the primary key in order, rather than sorting every
+            # unresolved profile from idx_profiles_username_status per page.
+            where_clause = "+username_status IS NULL AND id > ?"
+            sort_clause = "ORDER BY id"
+            params.append(after_id)
+        query = f"""
+        SELECT id, share_url
+        FROM profiles
+        WHERE {where_clause}
+        {sort_clause}
+        LIMIT ?;
+        """
+        params.append(_sql_limit(limit))
+        yield from self._iter_query(query, params, arraysize)
+
+    def _iter_missing_usernames_from_ltks(
+        self, limit: Optional[int], after_id: Optional[str], arraysize: int
+    ) -> Iterator[Tuple[str, str]]:
+        where_clause, params = "", []
+        if after_id is not None:
+            where_clause = "AND ltks.profile_user_id > ?"
+            params.append(after_id)
+        query = f"""
         SELECT ltks.profile_user_id, max(ltks.share_url)
         FROM ltks
         LEFT JOIN usernames ON usernames.id = ltks.profile_user_id
-        WHERE usernames.username IS NULL and usernames.error IS NULL
+        WHERE usernames.username IS NULL AND usernames.error IS NULL
+            AND ltks.profile_user_id IS NOT NULL {where_clause}
         GROUP BY ltks.profile_user_id
+        ORDER BY ltks.profile_user_id
         LIMIT ?;
         """
-        result = self.connection.execute(query, (limit,)).fetchall()
-        return [tuple(x) for x in result]
+        params.append(_sql_limit(limit))
+        yield from self._iter_query(query, params, arraysize)
+
+    def unresolved_profiles(self, ids: List[str]) -> List[Tuple[str, str]]:
+        """
+        Get (profile_user_id, share_url) tuples for the given profiles whose
+        usernames have not yet been looked up.
+        """
+        query = """
+        SELECT id, share_url FROM profiles
+        WHERE username_status IS NULL AND id IN ({})
+        """
+        return list(self._iter_in_query(query, ids))
 
     @retry_if_busy
     def profile_id_counts(self) -> Dict[str, int]:
-        return dict(
-            self.connection.execute(
-                "SELECT profile_id, SUM(1) FROM ltks GROUP BY profile_id;"
-            ).fetchall()
+        if self._check_profiles_backfilled():
+            query = """
+            SELECT profile_id, SUM(post_count) FROM profiles GROUP BY profile_id;
+            """
+        else:
+            query = "SELECT profile_id, SUM(1) FROM ltks GROUP BY profile_id;"
+        return dict(self.connection.execute(query).fetchall())
+
+    @retry_if_busy
+    def top_categories(self, limit: int) -> List[str]:
+        return [
+            row[0]
+            for row in self.connection.execute(
+                """
+                SELECT top_level_category FROM products
+                WHERE top_level_category IS NOT NULL
+                GROUP BY top_level_category
+                ORDER BY count(*) DESC
+                LIMIT ?;
+                """,
+                (limit,),
+            )
+        ]
+
+    @retry_if_busy
+    def top_retailers(self, limit: int) -> List[str]:
+        return [
+            row[0]
+            for row in self.connection.execute(
+                """
+                SELECT retailer_display_name FROM products
+                WHERE retailer_display_name IS NOT NULL
+                GROUP BY retailer_display_name
+                ORDER BY count(*) DESC
+                LIMIT ?;
+                """,
+                (limit,),
+            )
+        ]
+
+    def iter_recent_captions(
+        self, limit: Optional[int] = None, arraysize: int = 1000
+    ) -> Iterator[str]:
+        """Iterate over the captions of the most recently inserted posts."""
+        query = """
+        SELECT caption FROM ltks
+        WHERE caption IS NOT NULL
+        ORDER BY rowid DESC
+        LIMIT ?;
+        """
+        for row in self._iter_query(query, (_sql_limit(limit),), arraysize):
+            yield row[0]
+
+    @retry_if_busy
+    def add_search_queries(self, sources: Dict[str, str]):
+        """Add search queries, mapped to where they came from, if they are new."""
+        self.connection.executemany(
+            """
+            INSERT OR IGNORE INTO search_queries (
+                query, source, requests, new_ids, next_page, exhausted
+            ) VALUES (?, ?, 0, 0, 0, 0);
+            """,
+            list(sources.items()),
+        )
+        self.connection.commit()
+
+    @retry_if_busy
+    def next_search_queries(
+        self, limit: int, cooldown: float = 86400
+    ) -> List[Tuple[str, int, bool]]:
+        """
+        Get (query, next_page, exhausted) tuples of queries to search next,
+        highest yield of new post ids per request first. Untried queries
+        start with an optimistic yield of one, so every seed gets a chance.
+
+        Exhausted queries are only returned once cooldown seconds have passed
+        since they last ran, to check for new posts.
+        """
+        rows = self.connection.execute(
+            """
+            SELECT query, next_page, exhausted FROM search_queries
+            WHERE exhausted = 0 OR last_run IS NULL OR last_run <= ?
+            ORDER BY (new_ids + 1.0) / (requests + 1) DESC, requests
+            LIMIT ?;
+            """,
+            (int(time.time() - cooldown), limit),
+        ).fetchall()
+        return [(query, page, bool(exhausted)) for query, page, exhausted in rows]
+
+    @retry_if_busy
+    def record_search_query(
+        self, query: str, requests: int, new_ids: int, next_page: int, exhausted: bool
+    ):
+        self.connection.execute(
+            """
+            UPDATE search_queries SET
+                requests = requests + ?,
+                new_ids = new_ids + ?,
+                next_page = ?,
+                exhausted = ?,
+                last_run = ?
+            WHERE query = ?;
+            """,
+            (requests, new_ids, next_page, int(exhausted), int(time.time()), query),
         )
+        self.connection.commit()
 
     @retry_if_busy
     def insert_username(
@@ -476,4 +1269,87 @@ class DB:
         """
         cursor = self.connection.cursor()
         cursor.execute(query, (id, username, error)).fetchall()
+        cursor.execute(
+            "UPDATE profiles SET username_status = ? WHERE id = ?",
+            ("found" if username is not None else "error", id),
+        )
+        self.connection.commit()
+
+    @retry_if_busy
+    def insert_usernames(self, usernames: Dict[str, str]):
+        query = """
+        INSERT OR REPLACE INTO usernames (id, username, error)
+        VALUES (?, ?, NULL);
+        """
+        self.connection.executemany(query, list(usernames.items()))
+        self.connection.executemany(
+            "UPDATE profiles SET username_status = 'found' WHERE id = ?",
+            [(id,) for id in usernames.keys()],
+        )
         self.connection.commit()
+
+
+def _sql_limit(limit: Optional[int]) -> int:
+    # SQLite treats a negative LIMIT as no limit.
+    return -1 if limit is None else limit
+
+
+def _product_from_row(row: Tuple) -> Product:
+    (
+        id,
+        ltk_id,
+        hyperlink,
+        image_url,
+        retailer_display_name,
+        fetched_at,
+        details_id,
+        name,
+        advertiser_name,
+        advertiser_parent_id,
+        price,
+        local_price,
+        currency,
+        retailer_id,
+        retailer_ids,
+        min_price,
+        min_sale_price,
+        max_price,
+        max_sale_price,
+        top_level_category,
+    ) = row
+
+    details = None
+    if details_id:
+        details = ProductDetails(
+            id=details_id,
+            name=name,
+            advertiser_name=advertiser_name,
+            advertiser_parent_id=advertiser_parent_id,
+            price=price,
+            local_price=local_price,
+            currency=currency,
+            retailer_id=retailer_id,
+            retailer_ids=retailer_ids.split(",") if retailer_ids else [],
+            min_price=min_price,
+            min_sale_price=min_sale_price,
+            max_price=max_price,
+            max_sale_price=max_sale_price,
+            top_level_category=top_level_category,
+        )
+
+    return Product(
+        id=id,
+        ltk_id=ltk_id,
+        hyperlink=hyperlink,
+        image_url=image_url,
+        retailer_display_name=retailer_display_name,
+        retailer_id=retailer_id,
+        fetched_at=fetched_at,
+        details=details,
+    )
+
+
+def _ltk_from_row(row: Tuple) -> LTK:
+    ltk = LTK(*row)
+    ltk.product_ids = ltk.product_ids.split(",") if ltk.product_ids else []
+    return ltk
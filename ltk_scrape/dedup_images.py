@@ -0,0 +1,212 @@
+"""
+Compute perceptual hashes for downloaded images and group near-duplicates,
+such as re-crops and re-encodes of the same photo.
+
+Hashes are 64-bit DCT hashes (pHash). Groups are found with a multi-index
+hash: each hash is split into max_distance+1 chunks, and by the pigeonhole
+principle any two hashes within max_distance bits of each other must agree
+exactly on at least one chunk.
+"""
+
+import argparse
+import io
+from multiprocessing import Pool
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from .db import DB
+from .profiling import add_profiling_args, enable_profiling, profile_child
+
+HASH_INPUT_SIZE = 32
+HASH_LOW_FREQ = 8
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db_path", type=str, default="db.db")
+    parser.add_argument(
+        "--image_type", type=str, default="product", help="'product' or 'ltk'"
+    )
+    parser.add_argument("--batch_size", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--max_distance", type=int, default=4)
+    parser.add_argument("--skip_hashing", action="store_true")
+    add_profiling_args(parser)
+    args = parser.parse_args()
+    enable_profiling(args)
+
+    db = DB(args.db_path)
+
+    if not args.skip_hashing:
+        with Pool(args.workers, initializer=profile_child) as pool:
+            while True:
+                batch = db.missing_image_hashes(args.image_type, args.batch_size)
+                if not len(batch):
+                    break
+                ids, blobs = zip(*batch)
+                thumbnails = pool.map(decode_thumbnail, blobs)
+                hashes = hash_thumbnails(ids, thumbnails)
+                db.insert_image_hashes(args.image_type, hashes)
+                print(f"hashed {len(batch)} images")
+
+    print("finding near-duplicates...")
+    rows = db.image_hashes(args.image_type)
+    ids = [id for id, _ in rows]
+    hashes = np.array([h for _, h in rows], dtype=np.int64).view(np.uint64)
+    index = MultiIndexHash(hashes, args.max_distance)
+    groups = group_ids(list(ids), index.pairs())
+    db.set_duplicate_groups(args.image_type, groups)
+    print(
+        f"found {len(set(groups.values()))} groups "
+        f"covering {len(groups)} of {len(ids)} images"
+    )
+
+
+def decode_thumbnail(data: bytes) -> Tuple[Optional[bytes], Optional[str]]:
+    """
+    Decode an image into a small grayscale thumbnail, returning the raw
+    pixels or an error message.
+    """
+    try:
+        img = Image.open(io.BytesIO(data)).convert("L")
+        img = img.resize((HASH_INPUT_SIZE, HASH_INPUT_SIZE), Image.LANCZOS)
+        return img.tobytes(), None
+    except Exception as exc:
+        return None, str(exc)
+
+
+def hash_thumbnails(
+    ids: List[str], thumbnails: List[Tuple[Optional[bytes], Optional[str]]]
+) -> List[Tuple[str, Optional[int], Optional[str]]]:
+    """
+    Hash a batch of decoded thumbnails, producing (id, phash, error) rows
+    suitable for DB.insert_image_hashes().
+    """
+    valid = [i for i, (pixels, _) in enumerate(thumbnails) if pixels is not None]
+    results = [(id, None, err) for id, (_, err) in zip(ids, thumbnails)]
+    if not len(valid):
+        return results
+    pixels = np.stack(
+        [np.frombuffer(thumbnails[i][0], dtype=np.uint8) for i in valid]
+    ).reshape(-1, HASH_INPUT_SIZE, HASH_INPUT_SIZE)
+    hashes = phash(pixels).view(np.int64)
+    for i, h in zip(valid, hashes):
+        results[i] = (ids[i], int(h), None)
+    return results
+
+
+def phash(pixels: np.ndarray) -> np.ndarray:
+    """
+    Compute 64-bit perceptual hashes for a batch of [N x S x S] grayscale
+    images, returning a uint64 array of shape [N].
+    """
+    size = pixels.shape[-1]
+    dct = _dct_matrix(size)
+    coeffs = dct @ pixels.astype(np.float32) @ dct.T
+    low = coeffs[:, :HASH_LOW_FREQ, :HASH_LOW_FREQ].reshape(len(pixels), -1)
+    # Exclude the DC term from the median, since it only reflects brightness.
+    medians = np.median(low[:, 1:], axis=1, keepdims=True)
+    bits = np.packbits(low > medians, axis=1)
+    return bits.view(">u8").astype(np.uint64).reshape(-1)
+
+
+def _dct_matrix(size: int) -> np.ndarray:
+    n = np.arange(size)
+    result = np.cos(np.pi * (2 * n[None] + 1) * n[:, None] / (2 * size))
+    result[0] *= 1 / np.sqrt(2)
+    return (result * np.sqrt(2 / size)).astype(np.float32)
+
+
+def hamming_distance(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Count differing bits between (broadcastable) uint64 arrays."""
+    x = np.atleast_1d(np.bitwise_xor(a, b)).astype(np.uint64)
+    return _POPCOUNT[x.view(np.uint8).reshape(*x.shape, 8)].sum(-1)
+
+
+_POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(1)
+
+
+class MultiIndexHash:
+    """
+    An index over 64-bit hashes supporting queries for all hashes within a
+    fixed Hamming distance.
+    """
+
+    def __init__(self, hashes: np.ndarray, max_distance: int):
+        assert 0 <= max_distance < 64
+        self.hashes = hashes.astype(np.uint64)
+        self.max_distance = max_distance
+        bounds = np.linspace(0, 64, max_distance + 2).astype(np.int64)
+        self.chunks = list(zip(bounds[:-1], bounds[1:]))
+        self.tables: List[Dict[int, np.ndarray]] = []
+        for start, end in self.chunks:
+            keys = self._chunk(self.hashes, start, end)
+            order = np.argsort(keys, kind="stable")
+            unique, starts = np.unique(keys[order], return_index=True)
+            self.tables.append(
+                dict(zip(unique.tolist(), np.split(order, starts[1:])))
+            )
+
+    def query(self, h: int) -> np.ndarray:
+        """Get the indices of all hashes within max_distance of h."""
+        h = np.uint64(h)
+        candidates = []
+        for (start, end), table in zip(self.chunks, self.tables):
+            key = int(self._chunk(h, start, end))
+            if key in table:
+                candidates.append(table[key])
+        if not len(candidates):
+            return np.zeros([0], dtype=np.int64)
+        candidates = np.unique(np.concatenate(candidates))
+        distances = hamming_distance(self.hashes[candidates], h)
+        return candidates[distances <= self.max_distance]
+
+    def pairs(self) -> Iterator[Tuple[int, int]]:
+        """Iterate over all pairs (i, j) of near-duplicates with i < j."""
+        for i, h in enumerate(self.hashes):
+            for j in self.query(h):
+                if j > i:
+                    yield i, int(j)
+
+    @staticmethod
+    def _chunk(h: np.ndarray, start: int, end: int) -> np.ndarray:
+        mask = np.uint64((1 << int(end - start)) - 1)
+        return (h >> np.uint64(start)) & mask
+
+
+def group_ids(ids: List[str], pairs: Iterator[Tuple[int, int]]) -> Dict[str, str]:
+    """
+    Union near-duplicate pairs into groups, mapping each id which has at
+    least one duplicate to the smallest id in its group.
+    """
+    parents = {}
+
+    def find(i):
+        root = i
+        while parents.get(root, root) != root:
+            root = parents[root]
+        while i != root:
+            parents[i], i = root, parents.get(i, i)
+        return root
+
+    for i, j in pairs:
+        root_i, root_j = find(i), find(j)
+        if root_i != root_j:
+            parents[max(root_i, root_j)] = min(root_i, root_j)
+
+    members = {}
+    for i in list(parents.keys()):
+        members.setdefault(find(i), []).append(i)
+    result = {}
+    for root, group in members.items():
+        group.append(root)
+        group_id = min(ids[i] for i in group)
+        for i in group:
+            result[ids[i]] = group_id
+    return result
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,255 @@
+"""
+Export downloaded images with their metadata as training shards.
+
+Images are center-cropped and resized to a fixed square size. Two output
+formats are supported:
+
+ - "tar": WebDataset-style tar shards with a <key>.jpg and <key>.json
+   entry per sample.
+ - "array": a memory-mappable [N x S x S x 3] uint8 .npy file per shard,
+   with a .jsonl index holding each row's metadata in the same order.
+
+Each shard's ids are recorded in a <shard>.ids.json manifest before the
+shard is written, and shards are written atomically. Reruns keep the ids
+of every recorded shard, skip shards which already exist, and assign
+images which are in no shard yet to new shards, so that an interrupted
+export resumes where it stopped and later exports only add new images.
+"""
+
+import argparse
+import io
+import json
+import os
+import tarfile
+from multiprocessing import Pool
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from .db import DB, ImageSource, Product
+from .profiling import add_profiling_args, enable_profiling, profile_child
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db_path", type=str, default="db.db")
+    parser.add_argument("--output_dir", type=str, required=True)
+    parser.add_argument(
+        "--image_type", type=str, default="product", help="'product' or 'ltk'"
+    )
+    parser.add_argument("--format", type=str, default="tar", help="'tar' or 'array'")
+    parser.add_argument("--image_size", type=int, default=256)
+    parser.add_argument("--shard_size", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    add_profiling_args(parser)
+    args = parser.parse_args()
+    enable_profiling(args)
+
+    assert args.format in ("tar", "array"), f"unknown format: {args.format}"
+    os.makedirs(args.output_dir, exist_ok=True)
+    db = DB(args.db_path)
+
+    with Pool(args.workers, initializer=profile_child) as pool:
+        shards = shard_ids(db, args.output_dir, args.image_type, args.shard_size)
+        for shard_idx, ids in shards:
+            name = _shard_name(args.output_dir, shard_idx)
+            done_path = name + (".tar" if args.format == "tar" else ".jsonl")
+            if os.path.exists(done_path):
+                continue
+            metadata = image_metadata(db, args.image_type, ids)
+            blobs = db.get_images(args.image_type, ids)
+            samples = pool.imap(
+                prepare_sample,
+                [(blobs.get(id), args.image_size, args.format) for id in ids],
+                chunksize=16,
+            )
+            results = [
+                (metadata[id], sample)
+                for id, sample in zip(ids, samples)
+                if sample is not None
+            ]
+            if args.format == "tar":
+                write_tar_shard(name, results)
+            else:
+                write_array_shard(name, results, args.image_size)
+            print(f"wrote shard {shard_idx} with {len(results)} samples")
+
+
+def shard_ids(
+    db: DB, output_dir: str, source: ImageSource, shard_size: int
+) -> Iterator[Tuple[int, List[str]]]:
+    """
+    Iterate over (shard_idx, ids) for every shard, starting with the shards
+    recorded in output_dir. Images which are in none of them are assigned to
+    new shards in rowid order, recording each before it is yielded.
+    """
+    assigned = set()
+    shard_idx = 0
+    while True:
+        ids = _read_shard_ids(_shard_name(output_dir, shard_idx))
+        if ids is None:
+            break
+        assigned.update(ids)
+        yield shard_idx, ids
+        shard_idx += 1
+
+    ids = []
+    for id in db.iter_image_ids(source):
+        if id in assigned:
+            continue
+        assigned.add(id)
+        ids.append(id)
+        if len(ids) == shard_size:
+            _write_shard_ids(_shard_name(output_dir, shard_idx), ids)
+            yield shard_idx, ids
+            shard_idx += 1
+            ids = []
+    if len(ids):
+        _write_shard_ids(_shard_name(output_dir, shard_idx), ids)
+        yield shard_idx, ids
+
+
+def _shard_name(output_dir: str, shard_idx: int) -> str:
+    return os.path.join(output_dir, f"shard-{shard_idx:06d}")
+
+
+def _read_shard_ids(name: str) -> Optional[List[str]]:
+    try:
+        with open(name + ".ids.json", "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _write_shard_ids(name: str, ids: List[str]):
+    tmp_path = name + ".ids.json.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(ids, f)
+    os.rename(tmp_path, name + ".ids.json")
+
+
+def image_metadata(
+    db: DB, source: ImageSource, ids: List[str]
+) -> Dict[str, Dict[str, Any]]:
+    """
+    Get a JSON-serializable metadata dict per image id, including the post
+    caption and the products associated with the image.
+    """
+    if source == "product":
+        products = {x.id: x for x in db.get_products(ids)}
+        ltk_ids = list(set(x.ltk_id for x in products.values()))
+        ltks = {x.id: x for x in db.get_ltks(ltk_ids)}
+        result = {}
+        for id in ids:
+            product = products.get(id)
+            ltk = ltks.get(product.ltk_id) if product is not None else None
+            result[id] = dict(
+                id=id,
+                ltk_id=product.ltk_id if product is not None else None,
+                caption=ltk.caption if ltk is not None else None,
+                products=[_product_metadata(product)] if product is not None else [],
+            )
+        return result
+
+    ltks = {x.id: x for x in db.get_ltks(ids)}
+    product_ids = list(set(pid for ltk in ltks.values() for pid in ltk.product_ids))
+    products = {x.id: x for x in db.get_products(product_ids)}
+    result = {}
+    for id in ids:
+        ltk = ltks.get(id)
+        result[id] = dict(
+            id=id,
+            ltk_id=id,
+            caption=ltk.caption if ltk is not None else None,
+            products=[
+                _product_metadata(products[pid])
+                for pid in (ltk.product_ids if ltk is not None else [])
+                if pid in products
+            ],
+        )
+    return result
+
+
+def _product_metadata(product: Product) -> Dict[str, Any]:
+    details = product.details
+    return dict(
+        id=product.id,
+        retailer=product.retailer_display_name,
+        name=details.name if details else None,
+        price=details.price if details else None,
+        currency=details.currency if details else None,
+        category=details.top_level_category if details else None,
+    )
+
+
+def prepare_sample(item: Tuple[Optional[bytes], int, str]) -> Optional[bytes]:
+    """
+    Decode, center-crop and resize an image, returning JPEG bytes for tar
+    shards or raw RGB pixels for array shards. Returns None if the image
+    cannot be decoded.
+    """
+    data, size, format = item
+    if data is None:
+        return None
+    try:
+        img = Image.open(io.BytesIO(data)).convert("RGB")
+    except Exception:
+        return None
+    width, height = img.size
+    crop = min(width, height)
+    left, top = (width - crop) // 2, (height - crop) // 2
+    box = (left, top, left + crop, top + crop)
+    img = img.resize((size, size), Image.BICUBIC, box=box)
+    if format == "array":
+        return img.tobytes()
+    out = io.BytesIO()
+    img.save(out, format="JPEG", quality=90)
+    return out.getvalue()
+
+
+def write_tar_shard(name: str, results: List[Tuple[Dict[str, Any], bytes]]):
+    tmp_path = name + ".tar.tmp"
+    with tarfile.open(tmp_path, "w") as tar:
+        for metadata, image in results:
+            # WebDataset groups entries by the part of the name before the
+            # first dot, so keys must not contain dots.
+            key = metadata["id"].replace(".", "_")
+            _add_tar_file(tar, f"{key}.jpg", image)
+            _add_tar_file(tar, f"{key}.json", json.dumps(metadata).encode("utf-8"))
+    os.rename(tmp_path, name + ".tar")
+
+
+def _add_tar_file(tar: tarfile.TarFile, name: str, data: bytes):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tar.addfile(info, io.BytesIO(data))
+
+
+def write_array_shard(
+    name: str, results: List[Tuple[Dict[str, Any], bytes]], image_size: int
+):
+    tmp_npy = name + ".tmp.npy"
+    tmp_index = name + ".jsonl.tmp"
+    shape = (len(results), image_size, image_size, 3)
+    if not len(results):
+        # Empty arrays cannot be memory-mapped for writing.
+        np.save(tmp_npy, np.zeros(shape, dtype=np.uint8))
+    else:
+        arr = np.lib.format.open_memmap(
+            tmp_npy, mode="w+", dtype=np.uint8, shape=shape
+        )
+        for i, (_, pixels) in enumerate(results):
+            arr[i] = np.frombuffer(pixels, dtype=np.uint8).reshape(shape[1:])
+        arr.flush()
+        del arr
+    with open(tmp_index, "w") as f:
+        for i, (metadata, _) in enumerate(results):
+            f.write(json.dumps(dict(metadata, index=i)) + "\n")
+    os.rename(tmp_npy, name + ".npy")
+    # The index is renamed last, since its presence marks the shard as done.
+    os.rename(tmp_index, name + ".jsonl")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,450 @@
+"""
+Run versioned data migrations against a live database.
+
+Each migration walks its table in bounded rowid ranges. Every chunk is
+committed together with a checkpoint in the migrations table, so that the
+write lock is only held briefly, scrapers can keep writing between chunks,
+and an interrupted migration resumes where it left off.
+"""
+
+import argparse
+import sqlite3
+import time
+from dataclasses import dataclass
+from typing import Callable, List, Optional, Sequence, Tuple
+
+from .client import maybe_parse_float, parse_timestamp
+from .db import (
+    DB,
+    PROFILES_BACKFILL_VERSION,
+    create_change_triggers,
+    create_ltks_indexes,
+    create_migrations_table,
+    create_products_indexes,
+    create_products_table,
+    products_have_typed_prices,
+    retry_if_busy,
+)
+from .profiling import add_profiling_args, enable_profiling
+
+ChunkFn = Callable[[sqlite3.Connection, int, int], None]
+
+
+@dataclass
+class Migration:
+    version: int
+    name: str
+
+    # Migrate rows of table with lo < rowid <= hi, without committing.
+    # Schema-only migrations may leave these unset and just use hooks.
+    table: Optional[str] = None
+    apply_chunk: Optional[ChunkFn] = None
+
+    # Optional hooks run (and committed) before the first chunk and after
+    # the last chunk.
+    setup: Optional[Callable[[sqlite3.Connection], None]] = None
+    finish: Optional[Callable[[sqlite3.Connection], None]] = None
+
+    # If this returns True before the migration starts, it is marked as
+    # complete without running, e.g. for tables created with a newer schema.
+    skip_if: Optional[Callable[[sqlite3.Connection], bool]] = None
+
+
+def sql_migration(version: int, name: str, table: str, sql: str) -> Migration:
+    """
+    Create a set-based migration from a statement which restricts itself
+    to rows with :lo < rowid <= :hi.
+    """
+
+    def apply_chunk(conn: sqlite3.Connection, lo: int, hi: int):
+        conn.execute(sql, dict(lo=lo, hi=hi))
+
+    return Migration(version=version, name=name, table=table, apply_chunk=apply_chunk)
+
+
+def row_migration(
+    version: int,
+    name: str,
+    table: str,
+    columns: Sequence[str],
+    transform: Callable[[Tuple], Tuple],
+    where: str = "1",
+) -> Migration:
+    """
+    Create a migration which rewrites the given columns of every row
+    matching the where clause, by applying transform() to their old values.
+    """
+    select = (
+        f"SELECT rowid, {', '.join(columns)} FROM {table} "
+        f"WHERE rowid > ? AND rowid <= ? AND ({where})"
+    )
+    update = (
+        f"UPDATE {table} SET {', '.join(f'{c} = ?' for c in columns)} WHERE rowid = ?"
+    )
+
+    def apply_chunk(conn: sqlite3.Connection, lo: int, hi: int):
+        rows = conn.execute(select, (lo, hi)).fetchall()
+        conn.executemany(
+            update, [tuple(transform(tuple(row[1:]))) + (row[0],) for row in rows]
+        )
+
+    return Migration(version=version, name=name, table=table, apply_chunk=apply_chunk)
+
+
+def _copy_typed_products(conn: sqlite3.Connection, lo: int, hi: int):
+    conn.create_function(
+        "maybe_parse_float", 1, maybe_parse_float, deterministic=True
+    )
+    conn.execute(
+        """
+        INSERT OR REPLACE INTO products_typed (
+            id, ltk_id, hyperlink, image_url, retailer_display_name, fetched_at,
+            details_id, name, advertiser_name, advertiser_parent_id, price,
+            local_price, currency, retailer_id, retailer_ids, min_price,
+            min_sale_price, max_price, max_sale_price, top_level_category,
+            price_usd
+        )
+        SELECT
+            id, ltk_id, hyperlink, image_url, retailer_display_name, fetched_at,
+            details_id, name, advertiser_name, advertiser_parent_id, price,
+            local_price, currency, retailer_id, retailer_ids,
+            maybe_parse_float(min_price),
+            maybe_parse_float(min_sale_price),
+            maybe_parse_float(max_price),
+            maybe_parse_float(max_sale_price),
+            top_level_category,
+            price * (
+                SELECT usd_rate FROM currency_rates
+                WHERE currency_rates.currency = products.currency
+            )
+        FROM products
+        WHERE rowid > ? AND rowid <= ?
+        """,
+        (lo, hi),
+    )
+    # products_typed has no triggers, so record the rewritten rows here.
+    conn.execute(
+        """
+        INSERT INTO changes (table_name, row_id, op, changed_at)
+        SELECT 'products', id, 'update', CAST(strftime('%s', 'now') AS INTEGER)
+        FROM products
+        WHERE rowid > ? AND rowid <= ?
+        """,
+        (lo, hi),
+    )
+
+
+def _setup_typed_products(conn: sqlite3.Connection):
+    conn.execute("DROP TABLE IF EXISTS products_typed;")
+    create_products_table(conn, "products_typed")
+
+
+def _swap_typed_products(conn: sqlite3.Connection):
+    (last_rowid,) = conn.execute(
+        "SELECT last_rowid FROM migrations WHERE version = 2"
+    ).fetchone()
+    # Copy rows written since the last chunk and swap the tables atomically.
+    conn.execute("BEGIN IMMEDIATE;")
+    _copy_typed_products(conn, last_rowid, 2**63 - 1)
+    conn.execute("DROP TABLE products;")
+    conn.execute("ALTER TABLE products_typed RENAME TO products;")
+    create_products_indexes(conn)
+    # Dropping the old table also dropped its triggers.
+    create_change_triggers(conn, "products")
+
+
+def _replace_indexes(conn: sqlite3.Connection):
+    # Both were write overhead on every upsert without serving any query:
+    # idx_products_image_url_price also covers missing image scans, and
+    # usernames are resolved from the profiles table instead of ltks.
+    conn.execute("DROP INDEX IF EXISTS idx_products_image_url;")
+    conn.execute("DROP INDEX IF EXISTS idx_ltks_user_id;")
+    create_ltks_indexes(conn)
+
+
+def _setup_profiles_backfill(conn: sqlite3.Connection):
+    conn.execute("DROP TABLE IF EXISTS profiles_backfilled;")
+    conn.execute("CREATE TABLE profiles_backfilled (id TEXT PRIMARY KEY);")
+
+
+def _backfill_profiles(conn: sqlite3.Connection, lo: int, hi: int):
+    # Each profile is counted in full from idx_ltks_profile_user_id the first
+    # time one of its posts comes up, rather than adding up counts per chunk.
+    # This stays exact while upsert_ltks keeps incrementing counts, and when
+    # replaced posts move to new rowids.
+    conn.execute(
+        """
+        INSERT INTO profiles (id, profile_id, post_count, share_url, username_status)
+        SELECT
+            chunk.profile_user_id,
+            chunk.profile_id,
+            (
+                SELECT count(*) FROM ltks
+                WHERE ltks.profile_user_id = chunk.profile_user_id
+            ),
+            chunk.share_url,
+            CASE
+                WHEN usernames.username IS NOT NULL THEN 'found'
+                WHEN usernames.error IS NOT NULL THEN 'error'
+            END
+        FROM (
+            SELECT
+                profile_user_id,
+                max(profile_id) AS profile_id,
+                max(share_url) AS share_url
+            FROM ltks
+            WHERE rowid > ? AND rowid <= ? AND profile_user_id IS NOT NULL
+            GROUP BY profile_user_id
+        ) AS chunk
+        LEFT JOIN usernames ON usernames.id = chunk.profile_user_id
+        WHERE chunk.profile_user_id NOT IN (SELECT id FROM profiles_backfilled)
+        ON CONFLICT (id) DO UPDATE SET
+            profile_id = coalesce(profile_id, excluded.profile_id),
+            post_count = excluded.post_count,
+            share_url = coalesce(share_url, excluded.share_url),
+            username_status = coalesce(username_status, excluded.username_status);
+        """,
+        (lo, hi),
+    )
+    conn.execute(
+        """
+        INSERT OR IGNORE INTO profiles_backfilled (id)
+        SELECT DISTINCT profile_user_id FROM ltks
+        WHERE rowid > ? AND rowid <= ? AND profile_user_id IS NOT NULL
+        """,
+        (lo, hi),
+    )
+
+
+def _finish_profiles_backfill(conn: sqlite3.Connection):
+    conn.execute("DROP TABLE profiles_backfilled;")
+
+
+MIGRATIONS: List[Migration] = [
+    # Early scrapes inserted dates as ISO strings instead of epoch integers.
+    row_migration(
+        version=1,
+        name="convert_dates",
+        table="ltks",
+        columns=["date_created", "date_updated", "date_published"],
+        transform=lambda row: tuple(parse_timestamp(x) for x in row),
+        where="typeof(date_created) = 'text'",
+    ),
+    # Min/max prices used to be stored as text. SQLite cannot change column
+    # types in place, so the table is copied in chunks and then swapped.
+    Migration(
+        version=2,
+        name="typed_prices",
+        table="products",
+        apply_chunk=_copy_typed_products,
+        setup=_setup_typed_products,
+        finish=_swap_typed_products,
+        skip_if=products_have_typed_prices,
+    ),
+    # New databases get the replacement ltks indexes when they are created.
+    Migration(version=3, name="drop_redundant_indexes", finish=_replace_indexes),
+    # Databases with posts from before the profiles table existed. Newer
+    # databases mark this as complete when they are created.
+    Migration(
+        version=PROFILES_BACKFILL_VERSION,
+        name="backfill_profiles",
+        table="ltks",
+        apply_chunk=_backfill_profiles,
+        setup=_setup_profiles_backfill,
+        finish=_finish_profiles_backfill,
+    ),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db_path", type=str, default="db.db")
+    parser.add_argument("--chunk_size", type=int, default=10000)
+    parser.add_argument(
+        "--sleep", type=float, default=0.05, help="seconds to pause between chunks"
+    )
+    add_profiling_args(parser)
+    args = parser.parse_args()
+    enable_profiling(args)
+
+    db = DB(args.db_path)
+    run_migrations(db.connection, chunk_size=args.chunk_size, sleep=args.sleep)
+
+
+def run_migrations(
+    conn: sqlite3.Connection,
+    migrations: Optional[List[Migration]] = None,
+    chunk_size: int = 10000,
+    sleep: float = 0.05,
+):
+    _create_migrations_table(conn)
+    if migrations is None:
+        migrations = MIGRATIONS
+    for migration in sorted(migrations, key=lambda x: x.version):
+        run_migration(conn, migration, chunk_size=chunk_size, sleep=sleep)
+
+
+def run_migration(
+    conn: sqlite3.Connection,
+    migration: Migration,
+    chunk_size: int = 10000,
+    sleep: float = 0.05,
+):
+    _create_migrations_table(conn)
+    row = conn.execute(
+        "SELECT last_rowid, completed_at FROM migrations WHERE version = ?",
+        (migration.version,),
+    ).fetchone()
+    if row is not None and row[1] is not None:
+        return
+    if row is None:
+        if migration.skip_if is not None and migration.skip_if(conn):
+            _set_checkpoint(conn, migration, 0, completed=True)
+            return
+        _run_hook(conn, migration.setup)
+        _set_checkpoint(conn, migration, 0)
+        last_rowid = 0
+    else:
+        last_rowid = row[0]
+
+    print(f"running migration {migration.version} ({migration.name})...")
+    if migration.apply_chunk is not None:
+        last_rowid = run_chunked(
+            conn,
+            migration.table,
+            migration.apply_chunk,
+            start_rowid=last_rowid,
+            chunk_size=chunk_size,
+            sleep=sleep,
+            checkpoint=lambda x: _set_checkpoint(conn, migration, x, commit=False),
+        )
+    # Mark completion in the same transaction as the finish hook, so that a
+    # finish which is not idempotent never runs twice.
+    _run_hook(
+        conn,
+        migration.finish,
+        checkpoint=lambda: _set_checkpoint(
+            conn, migration, last_rowid, completed=True, commit=False
+        ),
+    )
+
+
+def run_chunked(
+    conn: sqlite3.Connection,
+    table: str,
+    apply_chunk: ChunkFn,
+    start_rowid: int = 0,
+    chunk_size: int = 10000,
+    sleep: float = 0.05,
+    checkpoint: Optional[Callable[[int], None]] = None,
+) -> int:
+    """
+    Apply a function to every rowid range of a table after start_rowid,
+    committing after each chunk. If provided, checkpoint() is called with
+    the end of each chunk inside that chunk's transaction.
+
+    Returns the last rowid which was processed.
+    """
+    from tqdm.auto import tqdm
+
+    last_rowid = start_rowid
+    max_rowid = _max_rowid(conn, table)
+    with tqdm(total=max_rowid, initial=last_rowid) as pbar:
+        while True:
+            # Rows written while we run are picked up by later chunks.
+            max_rowid = max(max_rowid, _max_rowid(conn, table))
+            if last_rowid >= max_rowid:
+                break
+            next_rowid = _chunk_end(conn, table, last_rowid, chunk_size)
+            _apply_chunk(conn, apply_chunk, last_rowid, next_rowid, checkpoint)
+            pbar.total = max_rowid
+            pbar.update(next_rowid - last_rowid)
+            last_rowid = next_rowid
+            if sleep:
+                time.sleep(sleep)
+    return last_rowid
+
+
+@retry_if_busy
+def _create_migrations_table(conn: sqlite3.Connection):
+    create_migrations_table(conn)
+    conn.commit()
+
+
+@retry_if_busy
+def _max_rowid(conn: sqlite3.Connection, table: str) -> int:
+    return conn.execute(f"SELECT max(rowid) FROM {table}").fetchone()[0] or 0
+
+
+@retry_if_busy
+def _chunk_end(conn: sqlite3.Connection, table: str, lo: int, size: int) -> int:
+    row = conn.execute(
+        f"SELECT rowid FROM {table} WHERE rowid > ? ORDER BY rowid LIMIT 1 OFFSET ?",
+        (lo, size - 1),
+    ).fetchone()
+    if row is None:
+        return _max_rowid(conn, table)
+    return row[0]
+
+
+@retry_if_busy
+def _apply_chunk(
+    conn: sqlite3.Connection,
+    apply_chunk: ChunkFn,
+    lo: int,
+    hi: int,
+    checkpoint: Optional[Callable[[int], None]],
+):
+    try:
+        apply_chunk(conn, lo, hi)
+        if checkpoint is not None:
+            checkpoint(hi)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+@retry_if_busy
+def _run_hook(
+    conn: sqlite3.Connection,
+    hook: Optional[Callable[[sqlite3.Connection], None]],
+    checkpoint: Optional[Callable[[], None]] = None,
+):
+    try:
+        if hook is not None:
+            hook(conn)
+        if checkpoint is not None:
+            checkpoint()
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+@retry_if_busy
+def _set_checkpoint(
+    conn: sqlite3.Connection,
+    migration: Migration,
+    last_rowid: int,
+    completed: bool = False,
+    commit: bool = True,
+):
+    conn.execute(
+        """
+        INSERT OR REPLACE INTO migrations (version, name, last_rowid, completed_at)
+        VALUES (?, ?, ?, ?)
+        """,
+        (
+            migration.version,
+            migration.name,
+            last_rowid,
+            int(time.time()) if completed else None,
+        ),
+    )
+    if commit:
+        conn.commit()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,301 @@
+"""
+Sampling profiler and SQL tracing for the scraping entry points.
+
+Both are configured through environment variables so that they carry
+over to multiprocessing children:
+
+ - LTK_SCRAPE_PROFILE: path for merged collapsed stacks, which can be
+   rendered with flamegraph.pl or speedscope. Children write their own
+   <path>.<pid> files, which are merged into <path> when the parent exits.
+ - LTK_SCRAPE_SQL_TRACE: path for JSON-lines SQL trace records, one per
+   statement, with the query plan and full table scans on first use.
+
+Run this module with a trace path to summarize a SQL trace.
+"""
+
+import argparse
+import atexit
+import glob
+import json
+import multiprocessing
+import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Any, Dict, List, Optional, Sequence
+
+PROFILE_ENV = "LTK_SCRAPE_PROFILE"
+SQL_TRACE_ENV = "LTK_SCRAPE_SQL_TRACE"
+
+_profiler: Optional["SamplingProfiler"] = None
+
+
+def add_profiling_args(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--profile",
+        type=str,
+        default=None,
+        help="write sampled stacks from all threads and worker processes here",
+    )
+    parser.add_argument(
+        "--trace_sql",
+        type=str,
+        default=None,
+        help="write every SQL statement's duration and query plan here",
+    )
+
+
+def enable_profiling(args: argparse.Namespace):
+    """Start profiling and tracing as requested by add_profiling_args()."""
+    global _profiler
+    if args.trace_sql is not None:
+        os.environ[SQL_TRACE_ENV] = os.path.abspath(args.trace_sql)
+    if args.profile is not None:
+        path = os.path.abspath(args.profile)
+        os.environ[PROFILE_ENV] = path
+        _profiler = SamplingProfiler(path)
+        _profiler.start()
+        atexit.register(_finish_main_profile)
+
+
+def profile_child(*_):
+    """
+    Start profiling in a worker process if the parent is profiling. This can
+    be used as a multiprocessing.Pool initializer.
+    """
+    global _profiler
+    path = os.environ.get(PROFILE_ENV)
+    if path is None:
+        return
+    _profiler = SamplingProfiler(f"{path}.{os.getpid()}", flush_interval=5.0)
+    _profiler.start()
+
+
+def _finish_main_profile():
+    _profiler.stop()
+    counts = _profiler.counts.copy()
+    for child_path in glob.glob(glob.escape(_profiler.path) + ".*"):
+        if not child_path.rsplit(".", 1)[1].isdigit():
+            continue
+        counts.update(_read_collapsed(child_path))
+        os.remove(child_path)
+    _write_collapsed(_profiler.path, counts)
+    print(f"wrote profile to {_profiler.path}")
+
+
+class SamplingProfiler:
+    """
+    Periodically sample the stacks of every thread in this process and
+    count identical stacks.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        interval: float = 0.005,
+        flush_interval: Optional[float] = None,
+    ):
+        self.path = path
+        self.interval = interval
+        self.flush_interval = flush_interval
+        self.counts: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="profiler-thread", daemon=True
+        )
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        process_name = multiprocessing.current_process().name
+        last_flush = time.time()
+        while not self._stop.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == threading.get_ident():
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    filename = os.path.basename(code.co_filename)
+                    line = code.co_firstlineno
+                    stack.append(f"{code.co_name} ({filename}:{line})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, "thread"))
+                stack.append(process_name)
+                self.counts[";".join(reversed(stack))] += 1
+            now = time.time()
+            if self.flush_interval and now > last_flush + self.flush_interval:
+                # Pool workers may be terminated without running any exit
+                # handlers, so children save their samples periodically.
+                _write_collapsed(self.path, self.counts)
+                last_flush = now
+
+
+def _write_collapsed(path: str, counts: Counter):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        for stack, count in counts.most_common():
+            f.write(f"{stack} {count}\n")
+    os.replace(tmp_path, path)
+
+
+def _read_collapsed(path: str) -> Counter:
+    counts = Counter()
+    with open(path, "r") as f:
+        for line in f:
+            stack, count = line.rstrip("\n").rsplit(" ", 1)
+            counts[stack] += int(count)
+    return counts
+
+
+class TracingConnection(sqlite3.Connection):
+    """
+    A connection which records the duration of every statement, and the
+    query plan of every distinct statement, to a JSON-lines file.
+
+    For SELECT statements, the duration only covers execute() and not the
+    time spent fetching rows.
+    """
+
+    trace_path: str = ""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.trace_path = os.environ[SQL_TRACE_ENV]
+        self._trace_lock = threading.Lock()
+        self._planned = set()
+        self._tables = None
+
+    def cursor(self, factory=None):
+        return super().cursor(factory or TracingCursor)
+
+    def execute(self, sql: str, parameters: Any = ()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql: str, seq_of_parameters: Any):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def trace(self, sql: str, parameters: Any, duration: float, count: int = 1):
+        record: Dict[str, Any] = dict(
+            sql=" ".join(sql.split()),
+            duration=duration,
+            count=count,
+            pid=os.getpid(),
+            thread=threading.current_thread().name,
+        )
+        if record["sql"] not in self._planned:
+            self._planned.add(record["sql"])
+            plan = self._query_plan(sql, parameters)
+            if plan is not None:
+                record["plan"] = plan
+                record["full_scans"] = self._full_scans(plan)
+        with self._trace_lock:
+            with open(self.trace_path, "a") as f:
+                f.write(json.dumps(record) + "\n")
+
+    def _query_plan(self, sql: str, parameters: Any) -> Optional[List[str]]:
+        if sql.lstrip().split(None, 1)[0].upper() not in (
+            "SELECT",
+            "WITH",
+            "INSERT",
+            "UPDATE",
+            "DELETE",
+        ):
+            return None
+        try:
+            rows = (
+                super()
+                .cursor()
+                .execute("EXPLAIN QUERY PLAN " + sql, parameters)
+                .fetchall()
+            )
+        except sqlite3.Error:
+            return None
+        return [row[-1] for row in rows]
+
+    def _full_scans(self, plan: List[str]) -> List[str]:
+        if self._tables is None:
+            rows = super().cursor().execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table'"
+            )
+            self._tables = set(row[0] for row in rows)
+        result = []
+        for detail in plan:
+            words = detail.split()
+            if words[0] != "SCAN" or "USING" in words:
+                continue
+            name = words[2] if words[1] == "TABLE" else words[1]
+            if name in self._tables:
+                result.append(detail)
+        return result
+
+
+class TracingCursor(sqlite3.Cursor):
+    def execute(self, sql: str, parameters: Any = ()):
+        t1 = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self.connection.trace(sql, parameters, time.perf_counter() - t1)
+
+    def executemany(self, sql: str, seq_of_parameters: Any):
+        seq_of_parameters = list(seq_of_parameters)
+        t1 = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self.connection.trace(
+                sql,
+                seq_of_parameters[0] if len(seq_of_parameters) else (),
+                time.perf_counter() - t1,
+                count=len(seq_of_parameters),
+            )
+
+
+def connect(filename: str) -> sqlite3.Connection:
+    """Open a connection, tracing it if SQL tracing is enabled."""
+    if os.environ.get(SQL_TRACE_ENV):
+        return sqlite3.connect(filename, factory=TracingConnection)
+    return sqlite3.connect(filename)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("trace_path", type=str)
+    parser.add_argument("--top", type=int, default=20)
+    args = parser.parse_args()
+
+    totals: Dict[str, List[float]] = {}
+    full_scans: Dict[str, Sequence[str]] = {}
+    with open(args.trace_path, "r") as f:
+        for line in f:
+            record = json.loads(line)
+            total = totals.setdefault(record["sql"], [0.0, 0])
+            total[0] += record["duration"]
+            total[1] += record["count"]
+            if record.get("full_scans"):
+                full_scans[record["sql"]] = record["full_scans"]
+
+    print("slowest statements by total time:")
+    slowest = sorted(totals.items(), key=lambda x: -x[1][0])[: args.top]
+    for sql, (duration, count) in slowest:
+        print(f"{duration:10.3f}s {count:8d}x  {sql[:120]}")
+    if full_scans:
+        print()
+        print("statements with full table scans:")
+        for sql, scans in full_scans.items():
+            print(f"  {sql[:120]}")
+            for scan in scans:
+                print(f"    {scan}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+"""
+Rebuild a database from the raw payloads recorded with --capture_dir.
+
+Segments are decoded in parallel, and their records are merged across all
+of the processes which wrote them and ingested in capture order, so later
+captures of a post or product replace earlier ones.
+"""
+
+import argparse
+import heapq
+import os
+from multiprocessing.pool import AsyncResult, Pool
+from typing import Any, Dict, Iterator, List, Tuple
+
+from .capture import read_segment, record_key, segment_streams
+from .client import decode_nuxt_state, harvest_usernames
+from .db import DB, LTK, Product
+from .profiling import add_profiling_args, enable_profiling, profile_child
+from .scrape_profiles import decode_ltks, decode_products
+
+# (captured_at, seq, ltks, products, usernames) for one captured record.
+DecodedRecord = Tuple[float, int, Dict[str, LTK], Dict[str, Product], Dict[str, str]]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--capture_dir", type=str, required=True)
+    parser.add_argument("--db_path", type=str, default="rebuilt.db")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--batch_size", type=int, default=10000)
+    add_profiling_args(parser)
+    args = parser.parse_args()
+    enable_profiling(args)
+
+    if os.path.exists(args.db_path):
+        raise FileExistsError(f"refusing to rebuild into existing {args.db_path}")
+
+    db = DB(args.db_path)
+    # A crash only loses the partial rebuild, which can simply be rerun.
+    db.connection.execute("PRAGMA synchronous = OFF;")
+
+    streams = segment_streams(args.capture_dir)
+    first_keys = {}
+    for stream in streams:
+        for path in stream:
+            segment = read_segment(path)
+            first = next(segment, None)
+            segment.close()
+            if first is not None:
+                first_keys[path] = record_key(first)
+    # The merge needs each segment roughly when its first record comes up,
+    # so decode them in that order.
+    order = sorted(first_keys, key=first_keys.get)
+    print(f"rebuilding from {len(order)} segments of {len(streams)} processes...")
+
+    with Pool(args.workers, initializer=profile_child) as pool:
+        decoded = _DecodedSegments(pool, order, window=2 * args.workers)
+        records = heapq.merge(
+            *[
+                _iter_stream([x for x in stream if x in first_keys], decoded, rank)
+                for rank, stream in enumerate(streams)
+            ],
+            key=lambda x: x[0],
+        )
+        ltks, products, usernames = {}, {}, {}
+        for _, (record_ltks, record_products, record_usernames) in records:
+            ltks.update(record_ltks)
+            products.update(record_products)
+            usernames.update(record_usernames)
+            if len(ltks) + len(products) >= args.batch_size:
+                _ingest(db, ltks, products, usernames)
+                ltks, products, usernames = {}, {}, {}
+        if len(ltks) or len(products) or len(usernames):
+            _ingest(db, ltks, products, usernames)
+
+
+class _DecodedSegments:
+    """
+    Decode segments in the pool in the given order, handing them out by
+    path. At most window segments are decoded ahead of being needed, so
+    that a slow merge does not buffer the whole capture in memory.
+    """
+
+    def __init__(self, pool: Pool, paths: List[str], window: int):
+        self._pool = pool
+        self._paths = iter(paths)
+        self._window = window
+        self._pending: Dict[str, AsyncResult] = {}
+        self._fill()
+
+    def pop(self, path: str) -> List[DecodedRecord]:
+        # A segment needed out of order is submitted past the window.
+        while path not in self._pending:
+            if not self._submit():
+                raise KeyError(path)
+        records = self._pending.pop(path).get()
+        self._fill()
+        return records
+
+    def _fill(self):
+        while len(self._pending) < self._window and self._submit():
+            pass
+
+    def _submit(self) -> bool:
+        path = next(self._paths, None)
+        if path is None:
+            return False
+        self._pending[path] = self._pool.apply_async(decode_segment, (path,))
+        return True
+
+
+def _iter_stream(
+    paths: List[str], decoded: _DecodedSegments, rank: int
+) -> Iterator[Tuple[Tuple[float, int, int], Any]]:
+    """
+    Iterate over the records of one process's segments, keyed for merging
+    with other processes. Ties in capture time are broken by process.
+    """
+    for path in paths:
+        for captured_at, seq, ltks, products, usernames in decoded.pop(path):
+            yield (captured_at, rank, seq), (ltks, products, usernames)
+
+
+def _ingest(
+    db: DB,
+    ltks: Dict[str, LTK],
+    products: Dict[str, Product],
+    usernames: Dict[str, str],
+):
+    db.upsert_ltks(list(ltks.values()))
+    db.upsert_products(list(products.values()))
+    db.insert_usernames(usernames)
+    print(f"ingested {len(ltks)} posts, {len(products)} products")
+
+
+def decode_segment(path: str) -> List[DecodedRecord]:
+    """Decode every record of a segment, in the order they were written."""
+    result = []
+    for record in read_segment(path):
+        ltks, products, usernames = decode_record(record)
+        result.append(record_key(record) + (ltks, products, usernames))
+    return result
+
+
+def decode_record(
+    record: Dict[str, Any]
+) -> Tuple[Dict[str, LTK], Dict[str, Product], Dict[str, str]]:
+    payload = record["payload"]
+    if record["kind"] == "nuxt":
+        post = decode_nuxt_state(
+            payload["ltks"],
+            payload["products"],
+            payload["media_objects"],
+            payload["product_details"],
+            payload["profiles"],
+        )
+        return post.ltks, post.products, post.usernames
+    elif record["kind"] == "api":
+        resp, details_resp = payload["ltks"], payload["product_details"]
+        ltks = decode_ltks(resp)
+
+        # Details were only fetched for products which were new at the
+        # time, and other products must not replace stored details.
+        has_details = {
+            x["id"]: bool(x["product_details_id"]) for x in resp["products"]
+        }
+        products = {
+            id: product
+            for id, product in decode_products(resp, details_resp).items()
+            if product.details is not None or not has_details[id]
+        }
+        usernames = harvest_usernames(
+            ltks.values(), resp.get("profiles", []), name_key="display_name"
+        )
+        return ltks, products, usernames
+    else:
+        raise ValueError(f"unknown record kind: {record['kind']}")
+
+
+if __name__ == "__main__":
+    main()
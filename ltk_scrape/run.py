@@ -0,0 +1,279 @@
+"""
+Run profile discovery, image downloads and username resolution together.
+
+Stages are connected by bounded in-memory queues: products and posts
+discovered by scrape_profile() go straight to the image stages, and newly
+seen profiles go straight to username resolution. Work which was already
+pending in the database is loaded once at startup. All image and username
+results are written by a single writer thread.
+"""
+
+import argparse
+import random
+import time
+from queue import Queue
+from threading import Lock, Thread
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+import requests
+
+from .capture import CaptureLog
+from .db import DB, ImageSource
+from .profiling import add_profiling_args, enable_profiling
+from .scrape_images import fetch_image
+from .scrape_profiles import scrape_profile
+from .scrape_usernames import UsernameResolver
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db_path", type=str, default="db.db")
+    parser.add_argument("--proxy", type=str, default=None)
+    parser.add_argument("--max_per_user", type=int, default=50)
+    parser.add_argument("--random_order", action="store_true")
+    parser.add_argument("--capture_dir", type=str, default=None)
+    parser.add_argument("--profile_workers", type=int, default=1)
+    parser.add_argument("--image_workers", type=int, default=4)
+    parser.add_argument("--hero_image_workers", type=int, default=2)
+    parser.add_argument("--username_workers", type=int, default=4)
+    parser.add_argument("--queue_size", type=int, default=1000)
+    parser.add_argument(
+        "--skip_backlog",
+        action="store_true",
+        help="only process work discovered during this run",
+    )
+    add_profiling_args(parser)
+    args = parser.parse_args()
+    enable_profiling(args)
+
+    proxies = None if args.proxy is None else {"http": args.proxy, "https": args.proxy}
+    pipeline = Pipeline(
+        db_path=args.db_path,
+        proxies=proxies,
+        queue_size=args.queue_size,
+        capture=None if args.capture_dir is None else CaptureLog(args.capture_dir),
+    )
+    pipeline.run(
+        profile_workers=args.profile_workers,
+        image_workers=args.image_workers,
+        hero_image_workers=args.hero_image_workers,
+        username_workers=args.username_workers,
+        max_per_user=args.max_per_user,
+        random_order=args.random_order,
+        load_backlog=not args.skip_backlog,
+    )
+
+
+class Pipeline:
+    def __init__(
+        self,
+        db_path: str,
+        proxies: Any = None,
+        queue_size: int = 1000,
+        capture: Optional[CaptureLog] = None,
+    ):
+        self.db_path = db_path
+        self.proxies = proxies
+        self.capture = capture
+        self.image_queues = {
+            "product": Queue(maxsize=queue_size),
+            "ltk": Queue(maxsize=queue_size),
+        }
+        self.username_queue = Queue(maxsize=queue_size)
+        self.write_queue = Queue(maxsize=queue_size)
+        self.resolver = UsernameResolver(proxies=proxies)
+        self._seen_profiles: Set[str] = set()
+        self._seen_lock = Lock()
+
+    def run(
+        self,
+        profile_workers: int = 1,
+        image_workers: int = 4,
+        hero_image_workers: int = 2,
+        username_workers: int = 4,
+        max_per_user: int = 50,
+        random_order: bool = False,
+        load_backlog: bool = True,
+    ):
+        db = DB(self.db_path)
+        # Products and posts stored from here on are queued by the profile
+        # workers which find them, so the backlog must not queue them again.
+        backlog_rowids = {
+            source: db.max_listing_rowid(source) for source in self.image_queues
+        }
+        items = list(db.profile_id_counts().items())
+        if random_order:
+            random.shuffle(items)
+        else:
+            items.sort(key=lambda x: x[1])
+        profile_queue = Queue()
+        for profile_id, _ in items:
+            profile_queue.put(profile_id)
+        for _ in range(profile_workers):
+            profile_queue.put(None)
+
+        writer = _start(self._writer)
+        consumers = (
+            [_start(self._image_worker, "product") for _ in range(image_workers)]
+            + [_start(self._image_worker, "ltk") for _ in range(hero_image_workers)]
+            + [_start(self._username_worker) for _ in range(username_workers)]
+        )
+        producers = [
+            _start(self._profile_worker, profile_queue, max_per_user)
+            for _ in range(profile_workers)
+        ]
+        if load_backlog:
+            producers.append(_start(self._load_backlog, backlog_rowids))
+
+        for thread in producers:
+            thread.join()
+        for source, queue in self.image_queues.items():
+            num_workers = image_workers if source == "product" else hero_image_workers
+            for _ in range(num_workers):
+                queue.put(None)
+        for _ in range(username_workers):
+            self.username_queue.put(None)
+        for thread in consumers:
+            thread.join()
+        self.resolver.close()
+        self.write_queue.put(None)
+        writer.join()
+
+    def _load_backlog(self, max_rowids: Dict[str, int], page_size: int = 1000):
+        db = DB(self.db_path)
+        # Read each backlog in bounded pages, so that memory use does not grow
+        # with the backlog, and no read transaction stays open while blocked
+        # on a full queue.
+        for source, queue in self.image_queues.items():
+            pages = _iter_pages(
+                lambda after_id: db.missing_images(
+                    source,
+                    page_size,
+                    after_id=after_id,
+                    max_rowid=max_rowids[source],
+                )
+            )
+            for page in pages:
+                for item in page:
+                    queue.put(item)
+        for page in _iter_pages(
+            lambda after_id: db.missing_usernames(page_size, after_id=after_id)
+        ):
+            self._enqueue_profiles(page)
+
+    def _profile_worker(self, profile_queue: Queue, max_per_user: int):
+        db = DB(self.db_path)
+        with requests.Session() as sess:
+            while True:
+                profile_id = profile_queue.get()
+                if profile_id is None:
+                    return
+                print(f"scraping profile {profile_id}...")
+                try:
+                    ltks, products = scrape_profile(
+                        sess,
+                        self.proxies,
+                        db,
+                        profile_id,
+                        max_per_user,
+                        capture=self.capture,
+                    )
+                except Exception as exc:
+                    print(f"failed to scrape profile {profile_id}: {exc}")
+                    continue
+                for product in products:
+                    self.image_queues["product"].put((product.id, product.image_url))
+                for ltk in ltks:
+                    self.image_queues["ltk"].put((ltk.id, ltk.hero_image))
+                user_ids = list(set(ltk.profile_user_id for ltk in ltks))
+                self._enqueue_profiles(db.unresolved_profiles(user_ids))
+
+    def _enqueue_profiles(self, profiles: List[Tuple[str, str]]):
+        for id, url in profiles:
+            with self._seen_lock:
+                if id in self._seen_profiles:
+                    continue
+                self._seen_profiles.add(id)
+            self.username_queue.put((id, url))
+
+    def _image_worker(self, source: ImageSource):
+        queue = self.image_queues[source]
+        with requests.Session() as sess:
+            while True:
+                item = queue.get()
+                if item is None:
+                    return
+                id, url = item
+                try:
+                    data = fetch_image(sess, url, self.proxies)
+                except Exception as exc:
+                    if "SOCKSHTTP" in str(exc):
+                        time.sleep(1.0)
+                    self._write("insert_image", source, id, None, str(exc))
+                    continue
+                self._write("insert_image", source, id, data)
+
+    def _username_worker(self, max_attempts: int = 3):
+        while True:
+            item = self.username_queue.get()
+            if item is None:
+                return
+            id, url = item
+            for attempt in range(max_attempts):
+                try:
+                    username, error = self.resolver.resolve(id, url)
+                    break
+                except requests.RequestException as exc:
+                    print(f"failed to resolve username for {id}: {exc}")
+                    time.sleep(2.0**attempt)
+            else:
+                # Proxy and connection failures are not the profile's fault,
+                # so leave it unresolved for a later run (or a later sighting
+                # in this one) instead of storing an error that is never
+                # retried.
+                with self._seen_lock:
+                    self._seen_profiles.discard(id)
+                continue
+            self._write("insert_username", id, username, error)
+
+    def _write(self, method: str, *args):
+        self.write_queue.put((method, args))
+
+    def _writer(self):
+        db = DB(self.db_path)
+        while True:
+            item = self.write_queue.get()
+            if item is None:
+                return
+            method, args = item
+            try:
+                getattr(db, method)(*args)
+            except Exception as exc:
+                # Keep draining the queue, or every worker would block on it.
+                print(f"failed to write {method} for {args[:2]}: {exc}")
+
+
+def _iter_pages(
+    fetch: Callable[[Optional[str]], List[Tuple[str, str]]]
+) -> Iterator[List[Tuple[str, str]]]:
+    """
+    Repeatedly call fetch() with the last id of the previous page, or None
+    for the first page, until it returns an empty page.
+    """
+    after_id = None
+    while True:
+        page = fetch(after_id)
+        if not len(page):
+            return
+        yield page
+        after_id = page[-1][0]
+
+
+def _start(fn: Callable, *args) -> Thread:
+    thread = Thread(target=fn, args=args, name=f"{fn.__name__}-thread", daemon=True)
+    thread.start()
+    return thread
+
+
+if __name__ == "__main__":
+    main()
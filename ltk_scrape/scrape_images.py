@@ -7,9 +7,9 @@ import traceback
 from typing import Any
 
 import requests
-from PIL import Image
 
 from .db import DB
+from .profiling import add_profiling_args, enable_profiling, profile_child
 
 
 def main():
@@ -24,7 +24,9 @@ def main():
     parser.add_argument("--proxy", type=str, default=None)
     parser.add_argument("--concurrency", type=int, default=4)
     parser.add_argument("--batch_size", type=int, default=10000)
+    add_profiling_args(parser)
     args = parser.parse_args()
+    enable_profiling(args)
 
     db = DB(args.db_path)
 
@@ -86,15 +88,12 @@ class Fetcher:
 
     @staticmethod
     def _worker(proxies, req_queue, resp_queue):
+        profile_child()
         with requests.Session() as sess:
             while True:
                 id, url = req_queue.get()
                 try:
-                    result_image = sess.get(
-                        url, stream=True, timeout=5, proxies=proxies
-                    ).content
-                    # Make sure the image is actually valid.
-                    Image.open(io.BytesIO(result_image)).load()
+                    result_image = fetch_image(sess, url, proxies)
                 except KeyboardInterrupt:
                     traceback.print_exc()
                     sys.exit(1)
@@ -109,5 +108,14 @@ class Fetcher:
                 resp_queue.put((id, result_image, None))
 
 
+def fetch_image(sess: requests.Session, url: str, proxies: Any) -> bytes:
+    from PIL import Image
+
+    result_image = sess.get(url, stream=True, timeout=5, proxies=proxies).content
+    # Make sure the image is actually valid.
+    Image.open(io.BytesIO(result_image)).load()
+    return result_image
+
+
 if __name__ == "__main__":
     main()
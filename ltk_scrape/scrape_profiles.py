@@ -1,11 +1,12 @@
 import random
 import argparse
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional, Tuple
 import requests
 
-from ltk_scrape.client import maybe_parse_float, parse_timestamp
-
+from .capture import CaptureLog
+from .client import harvest_usernames, maybe_parse_float, parse_timestamp
 from .db import DB, LTK, Product, ProductDetails
+from .profiling import add_profiling_args, enable_profiling
 
 
 def main():
@@ -14,9 +15,21 @@ def main():
     parser.add_argument("--max_per_user", type=int, default=50)
     parser.add_argument("--proxy", type=str, default=None)
     parser.add_argument("--random_order", action="store_true")
+    parser.add_argument("--capture_dir", type=str, default=None)
+    parser.add_argument(
+        "--id_filter",
+        action="store_true",
+        help="keep known ids in memory to skip most existence queries",
+    )
+    add_profiling_args(parser)
     args = parser.parse_args()
+    enable_profiling(args)
 
     db = DB(args.db_path)
+    if args.id_filter:
+        print("loading known ids...")
+        db.enable_id_filters()
+    capture = None if args.capture_dir is None else CaptureLog(args.capture_dir)
     proxies = None if args.proxy is None else {"http": args.proxy, "https": args.proxy}
 
     profile_id_to_count = db.profile_id_counts()
@@ -29,110 +42,180 @@ def main():
             items = sorted(profile_id_to_count.items(), key=lambda x: x[1])
         for profile, count in items:
             print(f"scraping profile {profile} which had {count} existing posts...")
-            payload = {
-                "query": "",
-                "ranking": "recent",
-                "profile_id": profile,
-                "page": 0,
-                "limit": args.max_per_user,
-                "analytics": ["version:3.458.0-COA-1609.1", "platform:web"],
-                "filters": [],
-            }
-            response = sess.post(
-                "https://api-gateway.rewardstyle.com/api/ltk/v2/search/shop",
-                timeout=10,
-                proxies=proxies,
-                json=payload,
-            ).json()
-            post_ids = list(set(x["objectID"] for x in response["hits"]))
-            scrape_ids = db.unscraped_ltks(post_ids)
-            print(f"scraping {len(scrape_ids)} posts...")
-
-            resp = fetch_all_ltks(sess, proxies, scrape_ids)
-
-            all_product_ids = list(set(obj["id"] for obj in resp["products"]))
-            scrape_product_ids = db.unscraped_products(all_product_ids)
-
-            detail_ids = list(
-                set(
-                    obj["product_details_id"]
-                    for obj in resp["products"]
-                    if obj["id"] in scrape_product_ids
-                )
+            scrape_profile(
+                sess, proxies, db, profile, args.max_per_user, capture=capture
             )
 
-            details_resp = fetch_all_product_details(sess, proxies, detail_ids)
-
-            product_details = {
-                data["id"]: ProductDetails(
-                    id=data["id"],
-                    name=data["name"],
-                    advertiser_name=data["advertiser_name"],
-                    advertiser_parent_id=data["advertiser_parent_id"],
-                    price=maybe_parse_float(data["price"]),
-                    local_price=maybe_parse_float(data["local_price"]),
-                    currency=data["currency"],
-                    retailer_id=data["retailer_id"],
-                    retailer_ids=data["retailer_ids"],
-                    min_price=data["min_price"],
-                    min_sale_price=data["min_sale_price"],
-                    max_price=data["max_price"],
-                    max_sale_price=data["max_sale_price"],
-                    top_level_category=data["top_level_category"],
-                )
-                for data in details_resp["product_details"]
-            }
-
-            media_objects = {obj["id"]: obj for obj in resp["media_objects"]}
-
-            ltks = {
-                data["id"]: LTK(
-                    id=data["id"],
-                    hero_image=data["hero_image"],
-                    hero_image_width=data["hero_image_width"],
-                    hero_image_height=data["hero_image_height"],
-                    video_url=media_objects.get(data.get("video_media_id"), {}).get(
-                        "media_cdn_url"
-                    ),
-                    profile_id=data["profile_id"],
-                    profile_user_id=data["profile_user_id"],
-                    status=data["status"],
-                    caption=data["caption"],
-                    share_url=data["share_url"],
-                    date_created=parse_timestamp(data["date_created"]),
-                    date_updated=parse_timestamp(data["date_updated"]),
-                    date_published=parse_timestamp(data["date_published"]),
-                    product_ids=data.get("product_ids", []),
-                    fetched_at=data.get("fetched_at"),
-                )
-                for data in resp["ltks"]
-                if data["id"] in scrape_ids
-            }
-
-            products = {
-                data["id"]: Product(
-                    id=data["id"],
-                    ltk_id=data["ltk_id"],
-                    hyperlink=data["hyperlink"],
-                    image_url=data["image_url"],
-                    retailer_display_name=data["retailer_display_name"],
-                    retailer_id=data["retailer_id"],
-                    fetched_at=data.get("fetched_at"),
-                    details=product_details.get(data["product_details_id"]),
-                )
-                for data in resp["products"]
-                if data["id"] in scrape_product_ids
-            }
-
-            db.upsert_ltks(list(ltks.values()))
-            db.upsert_products(list(products.values()))
+
+def scrape_profile(
+    sess: requests.Session,
+    proxies: Any,
+    db: DB,
+    profile_id: str,
+    max_posts: int,
+    capture: Optional[CaptureLog] = None,
+) -> Tuple[List[LTK], List[Product]]:
+    """
+    Scrape the most recent posts of a profile, storing and returning any
+    posts and products which were not already in the database.
+    """
+    post_ids = search_post_ids(sess, proxies, profile_id=profile_id, limit=max_posts)
+    return scrape_posts(sess, proxies, db, post_ids, capture=capture)
+
+
+def search_post_ids(
+    sess: requests.Session,
+    proxies: Any,
+    query: str = "",
+    profile_id: Optional[str] = None,
+    page: int = 0,
+    limit: int = 50,
+) -> List[str]:
+    """
+    Get the ids of one page of posts from the search endpoint, optionally
+    restricted to a single profile.
+    """
+    payload = {
+        "query": query,
+        "ranking": "recent",
+        "page": page,
+        "limit": limit,
+        "analytics": ["version:3.458.0-COA-1609.1", "platform:web"],
+        "filters": [],
+    }
+    if profile_id is not None:
+        payload["profile_id"] = profile_id
+    response = sess.post(
+        "https://api-gateway.rewardstyle.com/api/ltk/v2/search/shop",
+        timeout=10,
+        proxies=proxies,
+        json=payload,
+    ).json()
+    return list(set(x["objectID"] for x in response["hits"]))
+
+
+def scrape_posts(
+    sess: requests.Session,
+    proxies: Any,
+    db: DB,
+    post_ids: List[str],
+    capture: Optional[CaptureLog] = None,
+) -> Tuple[List[LTK], List[Product]]:
+    """
+    Fetch the given posts and their products, skipping any which are already
+    in the database. The new posts and products are stored and returned.
+    """
+    scrape_ids = db.unscraped_ltks(post_ids)
+    print(f"scraping {len(scrape_ids)} posts...")
+
+    resp = fetch_all_ltks(sess, proxies, scrape_ids)
+
+    all_product_ids = list(set(obj["id"] for obj in resp["products"]))
+    scrape_product_ids = db.unscraped_products(all_product_ids)
+
+    detail_ids = list(
+        set(
+            obj["product_details_id"]
+            for obj in resp["products"]
+            if obj["id"] in scrape_product_ids
+        )
+    )
+
+    details_resp = fetch_all_product_details(sess, proxies, detail_ids)
+
+    if capture is not None and len(scrape_ids):
+        capture.append("api", dict(ltks=resp, product_details=details_resp))
+
+    ltks = {id: ltk for id, ltk in decode_ltks(resp).items() if id in scrape_ids}
+    products = {
+        id: product
+        for id, product in decode_products(resp, details_resp).items()
+        if id in scrape_product_ids
+    }
+
+    db.upsert_ltks(list(ltks.values()))
+    db.upsert_products(list(products.values()))
+    db.insert_usernames(
+        harvest_usernames(
+            ltks.values(), resp.get("profiles", []), name_key="display_name"
+        )
+    )
+    return list(ltks.values()), list(products.values())
+
+
+def decode_ltks(resp: Dict[str, Any]) -> Dict[str, LTK]:
+    """Decode the posts in a response from fetch_all_ltks()."""
+    media_objects = {obj["id"]: obj for obj in resp["media_objects"]}
+    return {
+        data["id"]: LTK(
+            id=data["id"],
+            hero_image=data["hero_image"],
+            hero_image_width=data["hero_image_width"],
+            hero_image_height=data["hero_image_height"],
+            video_url=media_objects.get(data.get("video_media_id"), {}).get(
+                "media_cdn_url"
+            ),
+            profile_id=data["profile_id"],
+            profile_user_id=data["profile_user_id"],
+            status=data["status"],
+            caption=data["caption"],
+            share_url=data["share_url"],
+            date_created=parse_timestamp(data["date_created"]),
+            date_updated=parse_timestamp(data["date_updated"]),
+            date_published=parse_timestamp(data["date_published"]),
+            product_ids=data.get("product_ids", []),
+            fetched_at=data.get("fetched_at"),
+        )
+        for data in resp["ltks"]
+    }
+
+
+def decode_products(
+    resp: Dict[str, Any], details_resp: Dict[str, Any]
+) -> Dict[str, Product]:
+    """
+    Decode the products in a response from fetch_all_ltks(), attaching
+    details from a response from fetch_all_product_details().
+    """
+    product_details = {
+        data["id"]: ProductDetails(
+            id=data["id"],
+            name=data["name"],
+            advertiser_name=data["advertiser_name"],
+            advertiser_parent_id=data["advertiser_parent_id"],
+            price=maybe_parse_float(data["price"]),
+            local_price=maybe_parse_float(data["local_price"]),
+            currency=data["currency"],
+            retailer_id=data["retailer_id"],
+            retailer_ids=data["retailer_ids"],
+            min_price=maybe_parse_float(data["min_price"]),
+            min_sale_price=maybe_parse_float(data["min_sale_price"]),
+            max_price=maybe_parse_float(data["max_price"]),
+            max_sale_price=maybe_parse_float(data["max_sale_price"]),
+            top_level_category=data["top_level_category"],
+        )
+        for data in details_resp["product_details"]
+    }
+    return {
+        data["id"]: Product(
+            id=data["id"],
+            ltk_id=data["ltk_id"],
+            hyperlink=data["hyperlink"],
+            image_url=data["image_url"],
+            retailer_display_name=data["retailer_display_name"],
+            retailer_id=data["retailer_id"],
+            fetched_at=data.get("fetched_at"),
+            details=product_details.get(data["product_details_id"]),
+        )
+        for data in resp["products"]
+    }
 
 
 def fetch_all_ltks(
     sess: requests.Session, proxies: Any, ids: List[str], batch: int = 50
 ) -> Dict[str, Any]:
     if not len(ids):
-        return dict(products=[], media_objects=[], ltks=[])
+        return dict(products=[], media_objects=[], ltks=[], profiles=[])
     all_results = []
     for i in range(0, len(ids), batch):
         url = "https://api-gateway.rewardstyle.com/api/ltk/v2/ltks"
@@ -144,8 +227,8 @@ def fetch_all_ltks(
         all_results.append(resp)
     result = all_results[0]
     for next_result in all_results[1:]:
-        for k in ["products", "media_objects", "ltks"]:
-            result[k].extend(next_result[k])
+        for k in ["products", "media_objects", "ltks", "profiles"]:
+            result.setdefault(k, []).extend(next_result.get(k, []))
     return result
 
 
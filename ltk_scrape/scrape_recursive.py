@@ -1,10 +1,17 @@
 import argparse
+from collections import Counter
 from threading import Thread
 from queue import Queue
 import time
+from typing import List, Optional, Tuple
 
+from .capture import CaptureLog
 from .client import LTKClient
 from .db import DB
+from .profiling import add_profiling_args, enable_profiling
+
+# Posts with at least this many products get the full product score.
+PRODUCT_SCORE_CAP = 10
 
 
 def main():
@@ -13,11 +20,44 @@ def main():
     parser.add_argument("--db_path", type=str, default="db.db")
     parser.add_argument("--workers", type=int, default=4)
     parser.add_argument("--proxy", type=str, default=None)
+    parser.add_argument("--page_timeout", type=float, default=30.0)
+    parser.add_argument("--max_pages_per_browser", type=int, default=200)
+    parser.add_argument("--max_browser_rss_mb", type=float, default=1500.0)
+    parser.add_argument("--capture_dir", type=str, default=None)
+    parser.add_argument("--batch_size", type=int, default=50)
+    parser.add_argument(
+        "--candidate_window",
+        type=int,
+        default=5000,
+        help="number of unvisited posts to prioritize among: half of them the "
+        "most recently found, and half from a sweep over all unvisited posts",
+    )
+    parser.add_argument("--max_per_profile", type=int, default=2)
+    parser.add_argument("--recency_half_life_days", type=float, default=30.0)
+    parser.add_argument(
+        "--max_wait_days",
+        type=float,
+        default=7.0,
+        help="posts found this long ago get the full waiting score",
+    )
+    add_profiling_args(parser)
     args = parser.parse_args()
+    enable_profiling(args)
 
     db = DB(args.db_path)
+    capture = None if args.capture_dir is None else CaptureLog(args.capture_dir)
     req_queue = Queue(maxsize=50)
-    fetchers = [Fetcher(req_queue, proxy=args.proxy) for _ in range(args.workers)]
+    fetchers = [
+        Fetcher(
+            req_queue,
+            max_pages=args.max_pages_per_browser,
+            max_rss=int(args.max_browser_rss_mb * 2**20),
+            proxy=args.proxy,
+            page_timeout=args.page_timeout,
+            capture=capture,
+        )
+        for _ in range(args.workers)
+    ]
 
     try:
         if args.start_url is not None:
@@ -28,12 +68,29 @@ def main():
                 raise exc
             db.upsert_ltks(list(results.ltks.values()))
             db.upsert_products(list(results.products.values()))
+            db.insert_usernames(results.usernames)
 
+        sweep_rowid = 0
         while True:
             t1 = time.time()
-            unvisited = db.unvisited_ltks(limit=50)
+            num_recent = args.candidate_window // 2
+            swept = db.unvisited_ltk_candidates(
+                args.candidate_window - num_recent, after_rowid=sweep_rowid
+            )
+            # Start the sweep over once it reaches the newest posts.
+            if len(swept) < args.candidate_window - num_recent:
+                sweep_rowid = 0
+            else:
+                sweep_rowid = swept[-1][0]
+            unvisited = schedule_ltks(
+                db.unvisited_ltk_candidates(num_recent) + swept,
+                limit=args.batch_size,
+                max_per_profile=args.max_per_profile,
+                recency_half_life=args.recency_half_life_days * 86400,
+                max_wait=args.max_wait_days * 86400,
+            )
             t2 = time.time()
-            print(f"took {t2 - t1} seconds to find unvisited LTKs")
+            print(f"took {t2 - t1} seconds to schedule unvisited LTKs")
             if not len(unvisited):
                 print("no more remaining posts")
                 break
@@ -54,6 +111,7 @@ def main():
                     print(f"fetched id: {id}")
                     db.upsert_ltks(list(results.ltks.values()))
                     db.upsert_products(list(results.products.values()))
+                    db.insert_usernames(results.usernames)
                     db.mark_visited_ltk(id, error=None)
     finally:
         for _ in fetchers:
@@ -62,26 +120,144 @@ def main():
             f.thread.join()
 
 
+def schedule_ltks(
+    candidates: List[
+        Tuple[int, str, str, Optional[str], Optional[int], int, int, Optional[int]]
+    ],
+    limit: int,
+    max_per_profile: int = 2,
+    recency_half_life: float = 30 * 86400,
+    max_wait: float = 7 * 86400,
+    now: Optional[float] = None,
+) -> List[Tuple[str, str]]:
+    """
+    Pick up to limit (id, share_url) tuples to visit next, from the output
+    of DB.unvisited_ltk_candidates(). Duplicate candidates are ignored.
+
+    Posts score higher when they were published recently, when few posts of
+    their profile are known yet, and when they have more products. Posts
+    also gain score while they wait, up to max_wait seconds after we first
+    stored them, so that older posts eventually win. Posts stored before
+    that time was recorded count as having waited the longest. At most
+    max_per_profile posts of each profile are picked, unless there are too
+    few other profiles to fill the batch.
+    """
+    if now is None:
+        now = time.time()
+    scored = []
+    seen = set()
+    for row in candidates:
+        _, id, url, user_id, published, num_products, post_count, found_at = row
+        if id in seen:
+            continue
+        seen.add(id)
+        recency = 0.0
+        if isinstance(published, int):
+            recency = 0.5 ** (max(0.0, now - published) / recency_half_life)
+        waiting = 1.0
+        if found_at is not None:
+            waiting = min(1.0, max(0.0, now - found_at) / max_wait)
+        newness = 1.0 / max(1, post_count)
+        products = min(num_products, PRODUCT_SCORE_CAP) / PRODUCT_SCORE_CAP
+        score = recency + waiting + newness + products
+        scored.append((score, id, url, user_id))
+    scored.sort(key=lambda x: x[0], reverse=True)
+
+    result = []
+    overflow = []
+    counts = Counter()
+    for _, id, url, user_id in scored:
+        if len(result) == limit:
+            break
+        if user_id is not None and counts[user_id] >= max_per_profile:
+            overflow.append((id, url))
+            continue
+        counts[user_id] += 1
+        result.append((id, url))
+    result.extend(overflow[: limit - len(result)])
+    return result
+
+
 class Fetcher:
-    def __init__(self, queue: Queue, *args, **kwargs):
+    """
+    A worker thread which owns a single browser at a time.
+
+    The browser is recycled after max_pages page loads, or once its process
+    tree exceeds max_rss bytes of resident memory. If a fetch fails and the
+    browser no longer responds, it is restarted before the next request.
+    """
+
+    def __init__(
+        self,
+        queue: Queue,
+        *args,
+        max_pages: int = 200,
+        max_rss: int = 1500 * 2**20,
+        max_start_attempts: int = 3,
+        **kwargs,
+    ):
         self.queue = queue
+        self.max_pages = max_pages
+        self.max_rss = max_rss
+        self.max_start_attempts = max_start_attempts
         self.client_args = args
         self.client_kwargs = kwargs
         self.thread = Thread(target=self._worker, name="fetcher-thread")
         self.thread.start()
 
     def _worker(self):
-        client = LTKClient(*self.client_args, **self.client_kwargs)
-        while True:
-            req = self.queue.get()
-            if req is None:
-                return
-            id, url, resp_queue = req
+        client = None
+        num_pages = 0
+        try:
+            while True:
+                req = self.queue.get()
+                if req is None:
+                    return
+                id, url, resp_queue = req
+
+                if client is not None and self._should_recycle(client, num_pages):
+                    client.close()
+                    client = None
+                if client is None:
+                    try:
+                        client = self._start_client()
+                    except Exception as exc:
+                        resp_queue.put((id, None, exc))
+                        continue
+                    num_pages = 0
+
+                num_pages += 1
+                try:
+                    results = client.fetch_post(url)
+                    resp_queue.put((id, results, None))
+                except Exception as exc:
+                    if not client.is_healthy():
+                        print("restarting unresponsive browser")
+                        client.close()
+                        client = None
+                    resp_queue.put((id, None, exc))
+        finally:
+            if client is not None:
+                client.close()
+
+    def _start_client(self) -> LTKClient:
+        for i in range(self.max_start_attempts):
             try:
-                results = client.fetch_post(url)
-                resp_queue.put((id, results, None))
-            except Exception as exc:
-                resp_queue.put((id, None, exc))
+                return LTKClient(*self.client_args, **self.client_kwargs)
+            except Exception:
+                if i + 1 == self.max_start_attempts:
+                    raise
+                time.sleep(2**i)
+
+    def _should_recycle(self, client: LTKClient, num_pages: int) -> bool:
+        if num_pages >= self.max_pages:
+            print(f"recycling browser after {num_pages} pages")
+            return True
+        rss = client.rss_bytes()
+        if rss > self.max_rss:
+            print(f"recycling browser using {rss / 2**20:.1f} MiB")
+            return True
+        return False
 
 
 if __name__ == "__main__":
@@ -0,0 +1,242 @@
+"""
+Discover new posts and profiles by fanning out searches over seed terms.
+
+Seed queries are mined from the database: hashtags from recent captions,
+and the most common product categories and retailers. Those which found
+the most unknown posts per request so far are searched first.
+
+Results are ranked by recency, so each search starts from the first page
+and stops once it reaches posts which are already known. Any remaining
+budget backfills older results, resuming where the last backfill stopped.
+Once a query's backfill is exhausted, it is only searched again after a
+cooldown.
+"""
+
+import argparse
+import re
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from threading import local
+from typing import Any, Dict, Optional
+
+import requests
+
+from .capture import CaptureLog
+from .db import DB
+from .profiling import add_profiling_args, enable_profiling
+from .scrape_profiles import scrape_posts, search_post_ids
+
+HASHTAG_EXPR = re.compile(r"#(\w{3,})")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db_path", type=str, default="db.db")
+    parser.add_argument("--proxy", type=str, default=None)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--page_size", type=int, default=50)
+    parser.add_argument(
+        "--pages_per_query",
+        type=int,
+        default=5,
+        help="pages to fetch from a query before re-prioritizing",
+    )
+    parser.add_argument(
+        "--cooldown_hours",
+        type=float,
+        default=24.0,
+        help="wait this long before searching an exhausted query for new posts",
+    )
+    parser.add_argument(
+        "--max_requests",
+        type=int,
+        default=None,
+        help="stop after this many search requests",
+    )
+    parser.add_argument("--caption_sample", type=int, default=100000)
+    parser.add_argument("--num_hashtags", type=int, default=500)
+    parser.add_argument("--num_categories", type=int, default=50)
+    parser.add_argument("--num_retailers", type=int, default=200)
+    parser.add_argument("--capture_dir", type=str, default=None)
+    add_profiling_args(parser)
+    args = parser.parse_args()
+    enable_profiling(args)
+
+    proxies = None if args.proxy is None else {"http": args.proxy, "https": args.proxy}
+
+    db = DB(args.db_path)
+    print("mining seed queries...")
+    db.add_search_queries(
+        mine_seed_queries(
+            db,
+            caption_sample=args.caption_sample,
+            num_hashtags=args.num_hashtags,
+            num_categories=args.num_categories,
+            num_retailers=args.num_retailers,
+        )
+    )
+
+    searcher = SearchFanout(
+        args.db_path,
+        proxies=proxies,
+        page_size=args.page_size,
+        pages_per_query=args.pages_per_query,
+        capture=None if args.capture_dir is None else CaptureLog(args.capture_dir),
+    )
+    num_requests = 0
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        while args.max_requests is None or num_requests < args.max_requests:
+            queries = db.next_search_queries(
+                args.concurrency, cooldown=args.cooldown_hours * 3600
+            )
+            if not len(queries):
+                print("no more search queries to run")
+                break
+            futures = {
+                executor.submit(searcher.search, query, page, exhausted): query
+                for query, page, exhausted in queries
+            }
+            num_failed = 0
+            for future in as_completed(futures):
+                query = futures[future]
+                result = future.result()
+                num_failed += result.error is not None
+                num_requests += result.requests
+                db.record_search_query(
+                    query,
+                    requests=result.requests,
+                    new_ids=result.new_ids,
+                    next_page=result.next_page,
+                    exhausted=result.exhausted,
+                )
+                print(
+                    f"searched {query!r}: {result.new_ids} new posts from "
+                    f"{result.requests} requests"
+                    + ("" if result.error is None else f" ({result.error})")
+                )
+            if num_failed == len(queries):
+                print("every search in the last round failed; stopping")
+                break
+
+
+def mine_seed_queries(
+    db: DB,
+    caption_sample: int,
+    num_hashtags: int,
+    num_categories: int,
+    num_retailers: int,
+) -> Dict[str, str]:
+    """Get a dict mapping seed queries to where they came from."""
+    hashtags = Counter(
+        tag.lower()
+        for caption in db.iter_recent_captions(caption_sample)
+        for tag in HASHTAG_EXPR.findall(caption)
+    )
+    sources = {}
+    for retailer in db.top_retailers(num_retailers):
+        sources[retailer] = "retailer"
+    for category in db.top_categories(num_categories):
+        sources[category] = "category"
+    for tag, _ in hashtags.most_common(num_hashtags):
+        sources.setdefault(tag, "hashtag")
+    return sources
+
+
+@dataclass
+class SearchResult:
+    requests: int
+    new_ids: int
+    next_page: int
+    exhausted: bool
+    error: Optional[str] = None
+
+
+class SearchFanout:
+    """
+    Page through search queries, storing any posts (and their products)
+    which are not already in the database.
+
+    Each thread uses its own session and database connection.
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        proxies: Any = None,
+        page_size: int = 50,
+        pages_per_query: int = 5,
+        capture: Optional[CaptureLog] = None,
+    ):
+        self.db_path = db_path
+        self.proxies = proxies
+        self.page_size = page_size
+        self.pages_per_query = pages_per_query
+        self.capture = capture
+        self._local = local()
+
+    def search(self, query: str, next_page: int, exhausted: bool) -> SearchResult:
+        """
+        Fetch up to pages_per_query pages of a query. New posts are searched
+        for from the first page until a page contains none, and any pages
+        left over backfill older results from next_page, unless exhausted.
+        """
+        if not hasattr(self._local, "db"):
+            self._local.db = DB(self.db_path)
+            self._local.session = requests.Session()
+
+        result = SearchResult(
+            requests=0, new_ids=0, next_page=next_page, exhausted=exhausted
+        )
+        try:
+            page = 0
+            while result.requests < self.pages_per_query:
+                num_new = self._search_page(query, page, result)
+                if num_new is None:
+                    result.exhausted = True
+                    break
+                page += 1
+                if not num_new:
+                    break
+            else:
+                # Unknown posts may continue past the pages we fetched, so
+                # backfill from there instead.
+                result.next_page = page
+                result.exhausted = False
+            result.next_page = max(result.next_page, page)
+
+            while not result.exhausted and result.requests < self.pages_per_query:
+                if self._search_page(query, result.next_page, result) is None:
+                    result.exhausted = True
+                    break
+                # Only move past a page once its posts are stored.
+                result.next_page += 1
+        except KeyboardInterrupt:
+            raise
+        except Exception as exc:
+            # Failed requests still count against the query's yield.
+            result.requests = max(result.requests, 1)
+            result.error = str(exc)
+        return result
+
+    def _search_page(
+        self, query: str, page: int, result: SearchResult
+    ) -> Optional[int]:
+        """
+        Store the unknown posts on one page of results, returning how many
+        there were, or None if the page was empty.
+        """
+        db, sess = self._local.db, self._local.session
+        post_ids = search_post_ids(
+            sess, self.proxies, query=query, page=page, limit=self.page_size
+        )
+        result.requests += 1
+        if not len(post_ids):
+            return None
+        ltks, _ = scrape_posts(sess, self.proxies, db, post_ids, capture=self.capture)
+        result.new_ids += len(ltks)
+        return len(ltks)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,58 +1,141 @@
 import argparse
-import io
 import re
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import Lock, local
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urljoin
 
 import requests
-from PIL import Image
 
 from .db import DB
+from .profiling import add_profiling_args, enable_profiling
+
+USERNAME_EXPR = re.compile(r"https://www\.shopltk\.com/explore/([^/?#]+)(?:[/?#]|$)")
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--db_path", type=str, default="db.db")
     parser.add_argument("--proxy", type=str, default=None)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--batch_size", type=int, default=200)
+    add_profiling_args(parser)
     args = parser.parse_args()
+    enable_profiling(args)
 
     proxies = None if args.proxy is None else {"http": args.proxy, "https": args.proxy}
 
     db = DB(args.db_path)
+    resolver = UsernameResolver(proxies=proxies)
+
+    try:
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            # Page through the backlog once, so that profiles which failed
+            # with transient errors are left for a later run.
+            after_id = None
+            while True:
+                t1 = time.time()
+                unvisited = db.missing_usernames(args.batch_size, after_id=after_id)
+                t2 = time.time()
+                print(f"took {t2 - t1} seconds to find missing usernames")
+                if not len(unvisited):
+                    print("no more remaining usernames to fetch")
+                    break
+                after_id = unvisited[-1][0]
+                futures = {
+                    executor.submit(resolver.resolve, id, url): id
+                    for id, url in unvisited
+                }
+                for future in as_completed(futures):
+                    id = futures[future]
+                    try:
+                        username, error = future.result()
+                    except requests.RequestException as exc:
+                        if "SOCKSHTTP" in str(exc):
+                            raise
+                        print(f"failed to fetch {id}, leaving it for later: {exc}")
+                        continue
+                    print(f"fetched: {id} ...")
+                    db.insert_username(id, username=username, error=error)
+    finally:
+        resolver.close()
+
+
+class UsernameResolver:
+    """
+    Resolve profile usernames by following share URL redirects one hop at a
+    time, stopping as soon as a redirect points at the profile page.
+
+    Usernames and definitive failures, such as a share URL which does not
+    redirect to a profile, are cached per profile_user_id. Proxy, connection
+    and server errors say nothing about the profile, so they are raised as
+    requests.RequestException for the caller to retry, and never cached.
+
+    The resolver may be shared between threads; each thread uses its own
+    session until close() is called.
+    """
+
+    def __init__(self, proxies: Any = None, max_hops: int = 5, timeout: float = 10):
+        self.proxies = proxies
+        self.max_hops = max_hops
+        self.timeout = timeout
+        self._cache: Dict[str, Tuple[Optional[str], Optional[str]]] = {}
+        self._lock = Lock()
+        self._local = local()
+        self._sessions: List[requests.Session] = []
+
+    def resolve(self, id: str, url: str) -> Tuple[Optional[str], Optional[str]]:
+        """Get a tuple (username, error) for the profile."""
+        with self._lock:
+            if id in self._cache:
+                return self._cache[id]
+        try:
+            result = (self._follow(url), None)
+        except (KeyboardInterrupt, requests.RequestException):
+            raise
+        except Exception as exc:
+            result = (None, str(exc))
+        with self._lock:
+            self._cache[id] = result
+        return result
+
+    def _follow(self, url: str) -> str:
+        sess = self._session()
+        for _ in range(self.max_hops):
+            match = USERNAME_EXPR.search(url)
+            if match:
+                return match.group(1)
+            response = sess.head(
+                url, allow_redirects=False, timeout=self.timeout, proxies=self.proxies
+            )
+            location = response.headers.get("Location")
+            if location is None:
+                if response.status_code == 429 or response.status_code >= 500:
+                    response.raise_for_status()
+                raise ValueError(f"username not found in redirect URL: {url}")
+            url = urljoin(url, location)
+        match = USERNAME_EXPR.search(url)
+        if match:
+            return match.group(1)
+        raise ValueError(f"username not found after {self.max_hops} redirects: {url}")
+
+    def close(self):
+        """Close every thread's session. Threads must be done resolving."""
+        with self._lock:
+            sessions, self._sessions = self._sessions, []
+        for sess in sessions:
+            sess.close()
+        self._local = local()
 
-    with requests.Session() as sess:
-        while True:
-            t1 = time.time()
-            unvisited = db.missing_usernames(50)
-            t2 = time.time()
-            print(f"took {t2 - t1} seconds to find missing usernames")
-            if not len(unvisited):
-                print("no more remaining usernames to fetch")
-                break
-            for id, url in unvisited:
-                print(f"fetching: {id} ...")
-                try:
-                    response = sess.head(
-                        url, allow_redirects=True, timeout=10, proxies=proxies
-                    )
-                    redirect_location = response.url
-                    match = re.search(
-                        r"https://www\.shopltk\.com/explore/([^/]+)/",
-                        redirect_location,
-                    )
-                    if match:
-                        username = match.group(1)
-                    else:
-                        raise ValueError(
-                            f"username not found in redirect URL: {redirect_location}"
-                        )
-                except KeyboardInterrupt:
-                    raise
-                except Exception as exc:
-                    if "SOCKSHTTP" in str(exc):
-                        raise
-                    db.insert_username(id, username=None, error=str(exc))
-                    continue
-                db.insert_username(id, username)
+    def _session(self) -> requests.Session:
+        sess = getattr(self._local, "session", None)
+        if sess is None:
+            sess = requests.Session()
+            self._local.session = sess
+            with self._lock:
+                self._sessions.append(sess)
+        return sess
 
 
 if __name__ == "__main__":
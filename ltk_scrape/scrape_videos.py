@@ -0,0 +1,246 @@
+"""
+Download post videos to disk.
+
+Videos are streamed to a .part file in fixed-size chunks, so memory use
+does not depend on file size. Interrupted downloads are resumed with an
+HTTP Range request, and all downloads share one bandwidth budget.
+"""
+
+import argparse
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import local
+from typing import Any, Optional, Tuple
+from urllib.parse import urlparse
+
+import requests
+
+from .db import DB
+from .profiling import add_profiling_args, enable_profiling
+
+CHUNK_SIZE = 1 << 20
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db_path", type=str, default="db.db")
+    parser.add_argument("--video_dir", type=str, default="videos")
+    parser.add_argument("--proxy", type=str, default=None)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--batch_size", type=int, default=1000)
+    parser.add_argument("--max_mb", type=float, default=500.0)
+    parser.add_argument(
+        "--max_mbps",
+        type=float,
+        default=None,
+        help="total download rate across all workers, in megabytes per second",
+    )
+    parser.add_argument(
+        "--retry_errors",
+        action="store_true",
+        help="retry failed downloads, resuming any partial files",
+    )
+    add_profiling_args(parser)
+    args = parser.parse_args()
+    enable_profiling(args)
+
+    proxies = None if args.proxy is None else {"http": args.proxy, "https": args.proxy}
+
+    db = DB(args.db_path)
+    if args.retry_errors:
+        db.clear_video_errors()
+    downloader = VideoDownloader(
+        args.video_dir,
+        proxies=proxies,
+        max_bytes=int(args.max_mb * 2**20),
+        bandwidth=(
+            None if args.max_mbps is None else TokenBucket(args.max_mbps * 2**20)
+        ),
+    )
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        while True:
+            t1 = time.time()
+            missing = db.missing_videos(args.batch_size)
+            t2 = time.time()
+            print(f"took {t2 - t1} seconds to find missing videos")
+            if not len(missing):
+                print("no more remaining videos to download")
+                break
+            futures = {
+                executor.submit(downloader.download, id, url): id
+                for id, url in missing
+            }
+            for future in as_completed(futures):
+                id = futures[future]
+                try:
+                    path, size, sha256 = future.result()
+                except KeyboardInterrupt:
+                    raise
+                except Exception as exc:
+                    print(f"error for {id}: {exc}")
+                    db.insert_video(id, None, None, None, error=str(exc))
+                    continue
+                print(f"fetched {id} ({size} bytes)")
+                db.insert_video(id, path, size, sha256)
+
+
+class TokenBucket:
+    """
+    A bandwidth budget which may be shared between threads. Callers block in
+    consume() until enough bytes have accumulated at the configured rate.
+    """
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate, CHUNK_SIZE)
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, amount: int):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens += (now - self._last) * self.rate
+            self._tokens = min(self.burst, self._tokens)
+            self._last = now
+            # Going into debt lets chunks larger than the burst through, and
+            # makes later callers wait for it to be repaid.
+            self._tokens -= amount
+            wait = -self._tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+class VideoDownloader:
+    """
+    Stream videos into a directory, resuming partial downloads. Each thread
+    uses its own session.
+    """
+
+    def __init__(
+        self,
+        video_dir: str,
+        proxies: Any = None,
+        max_bytes: int = 500 * 2**20,
+        bandwidth: Optional[TokenBucket] = None,
+        timeout: float = 30,
+    ):
+        self.video_dir = video_dir
+        self.proxies = proxies
+        self.max_bytes = max_bytes
+        self.bandwidth = bandwidth
+        self.timeout = timeout
+        self._local = local()
+
+    def download(self, id: str, url: str) -> Tuple[str, int, str]:
+        """
+        Download a video, returning its (path, size, sha256). The path is
+        relative to video_dir.
+        """
+        ext = os.path.splitext(urlparse(url).path)[1] or ".mp4"
+        rel_path = os.path.join(id[:2], id + ext)
+        path = os.path.join(self.video_dir, rel_path)
+        part_path = path + ".part"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        digest = hashlib.sha256()
+        offset = 0
+        if os.path.exists(part_path):
+            offset = _hash_file(part_path, digest)
+
+        # Byte offsets must refer to the file as stored, not a compressed body.
+        headers = {"Accept-Encoding": "identity"}
+        if offset:
+            headers["Range"] = f"bytes={offset}-"
+        with self._session().get(
+            url,
+            headers=headers,
+            stream=True,
+            timeout=self.timeout,
+            proxies=self.proxies,
+        ) as response:
+            if response.status_code == 416 and offset:
+                if _total_size(response, offset) == offset:
+                    # The partial file already holds the whole video.
+                    os.replace(part_path, path)
+                    return rel_path, offset, digest.hexdigest()
+                # The partial file is longer than the video, or its size is
+                # unknown, so it cannot be trusted; start over.
+                response.close()
+                _remove(part_path)
+                return self.download(id, url)
+            response.raise_for_status()
+            if response.status_code != 206 and offset:
+                # The server ignored the range, so start over.
+                digest = hashlib.sha256()
+                offset = 0
+            total = _total_size(response, offset)
+            if total is not None and total > self.max_bytes:
+                _remove(part_path)
+                raise ValueError(f"video is too large: {total} bytes")
+
+            size = offset
+            with open(part_path, "ab" if offset else "wb") as f:
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    if self.bandwidth is not None:
+                        self.bandwidth.consume(len(chunk))
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        f.close()
+                        _remove(part_path)
+                        raise ValueError(f"video exceeded {self.max_bytes} bytes")
+                    f.write(chunk)
+                    digest.update(chunk)
+        if total is not None and size != total:
+            raise IOError(f"incomplete download: got {size} of {total} bytes")
+        os.replace(part_path, path)
+        return rel_path, size, digest.hexdigest()
+
+    def _session(self) -> requests.Session:
+        sess = getattr(self._local, "session", None)
+        if sess is None:
+            sess = requests.Session()
+            self._local.session = sess
+        return sess
+
+
+def _hash_file(path: str, digest: Any) -> int:
+    size = 0
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                return size
+            digest.update(chunk)
+            size += len(chunk)
+
+
+def _total_size(response: requests.Response, offset: int) -> Optional[int]:
+    content_range = response.headers.get("Content-Range")
+    if response.status_code in (206, 416) and content_range is not None:
+        # "bytes 100-199/1000", or "bytes */1000" for an unsatisfiable range.
+        total = content_range.rsplit("/", 1)[-1]
+        if total.isdigit():
+            return int(total)
+    if response.status_code == 416:
+        # The body describes the error, not the file.
+        return None
+    length = response.headers.get("Content-Length")
+    if length is not None and length.isdigit():
+        return offset + int(length) if response.status_code == 206 else int(length)
+    return None
+
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+if __name__ == "__main__":
+    main()